@@ -0,0 +1,207 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterable, Iterator
+
+import redis
+
+
+class RenderedFeed:
+    __slots__ = ("chunks", "etag", "last_modified")
+
+    def __init__(self, body: str | Iterable[bytes], last_modified: datetime | None = None, etag: str | None = None):
+        # the feed is kept as the byte chunks it was serialized in and streamed from them as is
+        self.chunks = [body.encode("utf-8")] if isinstance(body, str) else list(body)
+
+        if etag is None:
+            sha = hashlib.sha1()
+            for chunk in self.chunks:
+                sha.update(chunk)
+            etag = f'"{sha.hexdigest()}"'
+        self.etag = etag
+
+        # HTTP dates only have a resolution of one second
+        self.last_modified = (last_modified or datetime.now(timezone.utc)).replace(microsecond=0)
+
+    @property
+    def body(self) -> str:
+        return b"".join(self.chunks).decode("utf-8")
+
+    def iter_bytes(self, chunk_size: int = 65536) -> Iterator[bytes]:
+        for chunk in self.chunks:
+            if len(chunk) <= chunk_size:
+                yield chunk
+                continue
+            for start in range(0, len(chunk), chunk_size):
+                yield chunk[start : start + chunk_size]
+
+    @property
+    def last_modified_http(self) -> str:
+        return format_datetime(self.last_modified, usegmt=True)
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {"ETag": self.etag, "Last-Modified": self.last_modified_http}
+
+    def is_not_modified(self, if_none_match: str | None = None, if_modified_since: str | None = None) -> bool:
+        """Evaluates the conditional request headers of a client against this feed.
+        If-None-Match takes precedence over If-Modified-Since (RFC 7232, section 6).
+
+        Keyword Arguments:
+            if_none_match {str | None} -- value of the If-None-Match header (default: {None})
+            if_modified_since {str | None} -- value of the If-Modified-Since header (default: {None})
+
+        Returns:
+            bool -- True if the client already has this version of the feed, False otherwise
+        """
+        if if_none_match is not None:
+            etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+            return "*" in etags or self.etag in etags
+
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return self.last_modified <= since
+
+        return False
+
+
+class FeedCache:
+    def __init__(self, ttl: int = 3600, max_entries: int = 512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._entries: OrderedDict[tuple, tuple[float, RenderedFeed]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> RenderedFeed | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, feed = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return feed
+
+    def put(self, key: tuple, feed: RenderedFeed):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, feed)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class EventRenderCache:
+    """Rendered properties of single events, keyed by (hash of the upstream VEVENT, templates).
+    Between two refreshes of a feed nearly all events are unchanged and don't need to be rendered again.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[tuple, tuple] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> tuple | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, rendered: tuple):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PrerenderedFeedStore:
+    """Feeds rendered ahead of time by the RefreshScheduler, stored by calendar token in redis
+    so every worker can serve them without asking TISS.
+    """
+
+    KEY_PREFIX = "tisscal:feed:"
+
+    def __init__(self, redis_pool: redis.ConnectionPool, ttl: int = 1800, redis_client: redis.Redis | None = None):
+        self.redis_pool = redis_pool
+        self.ttl = ttl
+        # a client to use instead of one from redis_pool, e.g. an in-memory fake in tests and benchmarks
+        self.redis_client = redis_client
+
+    def get(self, token: str, config_version: str) -> RenderedFeed | None:
+        data = self._get_redis_connection().hgetall(self.KEY_PREFIX + token)
+        if not data or data.get("config_version") != config_version:
+            return None
+
+        return RenderedFeed(
+            data["body"],
+            last_modified=parsedate_to_datetime(data["last_modified"]),
+            etag=data["etag"],
+        )
+
+    def put(self, token: str, config_version: str, feed: RenderedFeed):
+        with self._get_redis_connection().pipeline() as pipe:
+            pipe.hset(
+                self.KEY_PREFIX + token,
+                mapping={
+                    "body": feed.body,
+                    "etag": feed.etag,
+                    "last_modified": feed.last_modified_http,
+                    "config_version": config_version,
+                },
+            )
+            pipe.expire(self.KEY_PREFIX + token, self.ttl)
+            pipe.execute()
+
+    def delete(self, token: str):
+        self._get_redis_connection().delete(self.KEY_PREFIX + token)
+
+    def _get_redis_connection(self) -> redis.Redis:
+        if self.redis_client is not None:
+            return self.redis_client
+        return redis.Redis(connection_pool=self.redis_pool)
@@ -1,35 +1,78 @@
 import csv
+import os
 import re
 import urllib.parse
-from functools import cache
+from functools import lru_cache
+from typing import NamedTuple
 
 from icalendar.cal import Event
-from jinja2 import BaseLoader, Environment
+from jinja2 import BaseLoader, Environment, Template
 
+TEMPLATE_ENVIRONMENT = Environment(loader=BaseLoader())
+ROOMS_FILE = "resources/TU-Rooms.csv"
 
-@cache
-def read_rooms(file="resources/TU-Rooms.csv"):
-    # TODO: Maybe move this also to a database
-    with open(file, "r", encoding="UTF-8") as csvfile:
-        reader = csv.reader(csvfile, delimiter=";")
-        return [room for room in reader]
 
+class Room(NamedTuple):
+    name: str
+    tiss_link: str
+    tuw_map_link: str
+    building_address: str
+
+
+class RoomIndex:
+    __slots__ = ("rooms", "normalized_rooms", "version")
+
+    def __init__(self, rooms: dict[str, Room], version: int = 0):
+        self.rooms = rooms
+        # changes whenever the csv file changes, part of the keys of everything rendered with room data
+        self.version = version
+        self.normalized_rooms = {RoomIndex.normalize(name): room for name, room in rooms.items()}
+
+    def get(self, room_name: str) -> Room | None:
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = self.normalized_rooms.get(RoomIndex.normalize(room_name))
+        return room
+
+    @staticmethod
+    def normalize(room_name: str) -> str:
+        return " ".join(room_name.split()).casefold()
 
-def get_room_data(room_name=None):
-    if room_name == "":
-        return None
 
-    for room in read_rooms():
-        if room_name == room[0]:
-            return [
-                room[0],  # Room Name
-                room[8],  # Tiss Link
-                f"https://maps.tuwien.ac.at/?q={room[7]}#map",  # TU Wien Maps Link
-                room[6].split(",")[0],  # Real World Location
-            ]
-    else:
+@lru_cache(maxsize=1)
+def _load_room_index(file: str, mtime: int) -> RoomIndex:
+    # TODO: Maybe move this also to a database
+    rooms = {}
+    with open(file, "r", encoding="utf-8-sig") as csvfile:
+        for room in csv.reader(csvfile, delimiter=";"):
+            if len(room) < 9 or room[0] in rooms:
+                continue
+            rooms[room[0]] = Room(
+                name=room[0],
+                tiss_link=room[8],
+                tuw_map_link=f"https://maps.tuwien.ac.at/?q={room[7]}#map",
+                building_address=room[6].split(",")[0],
+            )
+    return RoomIndex(rooms, version=mtime)
+
+
+def read_rooms(file=ROOMS_FILE) -> RoomIndex:
+    # the index is rebuilt whenever the csv file changes
+    return _load_room_index(file, os.stat(file).st_mtime_ns)
+
+
+def get_room_data(room_name=None) -> Room | None:
+    if not room_name:
         return None
 
+    return read_rooms().get(room_name)
+
+
+@lru_cache(maxsize=256)
+def get_template(source: str) -> Template:
+    # Compiled templates are shared by all events, use get_template.cache_info() for hits/misses
+    return TEMPLATE_ENVIRONMENT.from_string(source)
+
 
 class Lva:
     PROPERTIES_TEMPLATE = [
@@ -88,6 +131,8 @@ class Lva:
         "ZU": "Zeichenübung",
     }
 
+    LVA_PATTERN = re.compile("^(.{3}\\..{3}) (.{2}) (.*)$")
+
     def __init__(self, properites, ical_event: Event):
         self.properties = properites
         self.ical_event = ical_event
@@ -109,47 +154,68 @@ class Lva:
         return f'data:text/html,{uri_encoded}'
 
     def _apply_format(self, format):
-        rtemplate = Environment(loader=BaseLoader()).from_string(format)
-        return rtemplate.render(**self.properties)
+        return get_template(format).render(**self.properties)
 
-    @staticmethod
-    def is_lva(ical_event: Event) -> bool:
-        pattern = re.compile("^(.{3}\..{3}) (.{2}) (.*)$")
-        return "summary" in ical_event and pattern.match(ical_event["summary"])
+    @classmethod
+    def is_lva(cls, ical_event: Event) -> bool:
+        return "summary" in ical_event and cls.LVA_PATTERN.match(ical_event["summary"])
 
-    @staticmethod
-    def is_lva_str(event_summary: str) -> bool:
-        pattern = re.compile("^(.{3}\..{3}) (.{2}) (.*)$")
-        return pattern.match(event_summary) is not None
+    @classmethod
+    def is_lva_str(cls, event_summary: str) -> bool:
+        return cls.LVA_PATTERN.match(event_summary) is not None
 
     @classmethod
-    def lva_from_ical_event(cls, ical_event):
-        pattern = re.compile("^(.{3}\..{3}) (.{2}) (.*)$")
+    def course_properties_from_summary(cls, summary: str) -> dict | None:
+        """Computes the properties that are the same for every occurrence of a course
+
+        Arguments:
+            summary {str} -- summary of the event as it comes from TISS (e.g. "104.265 VO Algebra ...")
+
+        Returns:
+            dict | None -- the course properties, None if the summary does not belong to an LVA
+        """
+        match = cls.LVA_PATTERN.match(summary)
+        if match is None:
+            return None
+
+        lva_id, lva_type_short, lva_name = match.groups()
+        lva_type_long = cls.LVA_TYPE_MAP[lva_type_short]
 
+        tiss_course_detail_link = f'https://tiss.tuwien.ac.at/course/courseDetails.xhtml?courseNr={lva_id.replace(".", "")}'
+        tiss_education_detail_link = f'https://tiss.tuwien.ac.at/course/educationDetails.xhtml?courseNr={lva_id.replace(".", "")}'
+
+        return {
+            "LvaName": lva_name,
+            "LvaTypeShort": lva_type_short,
+            "LvaTypeLong": lva_type_long,
+            "LvaId": lva_id,
+            "TissCourseDetailLink": tiss_course_detail_link,
+            "TissEducationDetailLink": tiss_education_detail_link,
+        }
+
+    @classmethod
+    def lva_from_ical_event(cls, ical_event, course_properties: dict = None):
         # if not LVA
         if not cls.is_lva(ical_event):
             return None
 
         # if LVA
-        match = pattern.match(ical_event["summary"])
-        lva_id, lva_type_short, lva_name = match.groups()
-        lva_type_long = cls.LVA_TYPE_MAP[lva_type_short]
+        if course_properties is None:
+            course_properties = cls.course_properties_from_summary(ical_event["summary"])
 
         start_date, start_time = ical_event["dtstart"].dt.strftime("%d.%m.%Y %H:%M").split(" ")
         end_date, end_time = ical_event["dtend"].dt.strftime("%d.%m.%Y %H:%M").split(" ")
 
-        tiss_course_detail_link = f'https://tiss.tuwien.ac.at/course/courseDetails.xhtml?courseNr={lva_id.replace(".", "")}'
-        tiss_education_detail_link = f'https://tiss.tuwien.ac.at/course/educationDetails.xhtml?courseNr={lva_id.replace(".", "")}'
         tiss_cal_desc = ical_event["description"]
 
         categorie = str(ical_event["categories"].cats[0])
 
         room_data = get_room_data(ical_event.get("location", None))
         if room_data is not None:
-            room_name = room_data[0]
-            room_tiss = room_data[1]
-            room_tuw_map = room_data[2]
-            room_building_address = room_data[3]
+            room_name = room_data.name
+            room_tiss = room_data.tiss_link
+            room_tuw_map = room_data.tuw_map_link
+            room_building_address = room_data.building_address
         elif "location" in ical_event:
             room_name = ical_event["location"]
             room_tiss = ical_event["location"]
@@ -162,16 +228,11 @@ class Lva:
             room_building_address = None
 
         props = {
-            "LvaName": lva_name,
-            "LvaTypeShort": lva_type_short,
-            "LvaTypeLong": lva_type_long,
-            "LvaId": lva_id,
+            **course_properties,
             "StartDate": start_date,
             "StartTime": start_time,
             "EndDate": end_date,
             "EndTime": end_time,
-            "TissCourseDetailLink": tiss_course_detail_link,
-            "TissEducationDetailLink": tiss_education_detail_link,
             "TissCalDesc": tiss_cal_desc,
             "RoomName": room_name,
             "RoomTiss": room_tiss,
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+        self.constant_labels: dict[str, str] = {}
+        self._values: dict[tuple, object] = {}
+        self._functions: dict[tuple, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, func: Callable[[], float], **labels: str):
+        """The value of the metric is read from func whenever the metrics are collected"""
+        self._functions[self._key(labels)] = func
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+        for key, func in self._functions.items():
+            yield self.name, dict(zip(self.labelnames, key)), func()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [
+            f"{name}{_format_labels({**self.constant_labels, **labels})} {_format_value(value)}"
+            for name, labels, value in self.samples()
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            # per bucket counts (not cumulative), the last one is +Inf, followed by the sum
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+
+        for key, counts in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(float(bound))}, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self, constant_labels: dict[str, str] = None):
+        self.metrics: list[_Metric] = []
+        self.constant_labels = constant_labels or {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        metric.constant_labels = self.constant_labels
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format (version 0.0.4)"""
+        return "".join(metric.render() for metric in self.metrics)
+
+
+# every worker process has its own metrics, the worker label keeps their series apart
+REGISTRY = MetricsRegistry(constant_labels={"worker": str(os.getpid())})
+
+STAGE_SECONDS: Histogram = REGISTRY.register(
+    Histogram("tisscal_stage_duration_seconds", "Time spent in each stage of serving or refreshing a feed.", ("stage",))
+)
+CACHE_LOOKUPS: Counter = REGISTRY.register(
+    Counter("tisscal_cache_lookups_total", "Lookups in the caches of the backend by result.", ("cache", "result"))
+)
+CACHE_ENTRIES: Gauge = REGISTRY.register(Gauge("tisscal_cache_entries", "Number of entries in the in-memory caches.", ("cache",)))
+UPSTREAM_RESPONSES: Counter = REGISTRY.register(
+    Counter("tisscal_upstream_responses_total", "Responses from TISS by HTTP status (error if the request failed).", ("status",))
+)
+FEED_REQUESTS: Counter = REGISTRY.register(
+    Counter("tisscal_feed_requests_total", "Requests for formatted calendar feeds by HTTP status.", ("status",))
+)
+
+
+class ServerTiming:
+    """Collects the durations of all stages timed while it is active (also in threads started with
+    asyncio.to_thread) for the Server-Timing header of one response.
+    """
+
+    _current: ContextVar["ServerTiming | None"] = ContextVar("server_timing", default=None)
+
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = ServerTiming._current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        ServerTiming._current.reset(self._token)
+
+    def add(self, stage: str, duration: float):
+        self.durations[stage] = self.durations.get(stage, 0.0) + duration
+
+    def header(self) -> str:
+        return ", ".join(f"{stage};dur={duration * 1000:.1f}" for stage, duration in self.durations.items())
+
+    @classmethod
+    def current(cls) -> "ServerTiming | None":
+        return cls._current.get()
+
+
+@contextmanager
+def timed(stage: str):
+    """Records the duration of the block in STAGE_SECONDS and in the active ServerTiming"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        if (server_timing := ServerTiming.current()) is not None:
+            server_timing.add(stage, duration)
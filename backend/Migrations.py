@@ -0,0 +1,85 @@
+import logging
+from typing import Callable, NamedTuple
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.database import Database
+
+from models.TissCalModels import event_config_key
+
+MIGRATIONS_COLLECTION = "migrations"
+SCHEMA_STATE_ID = "schema"
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Database], None]
+
+
+def _create_indexes(db: Database):
+    calendars = db.get_collection("calendars")
+    # every feed request looks up its calendar by token
+    calendars.create_index([("token", ASCENDING)], unique=True, name="token_unique")
+    # calendars of a user, ordered by _id for the paginated list
+    calendars.create_index([("owner", ASCENDING), ("_id", ASCENDING)], name="owner_id")
+
+    users = db.get_collection("users")
+    users.create_index([("usernameLower", ASCENDING)], name="usernameLower")
+
+
+def _key_events_by_name(db: Database, batch_size: int = 500):
+    calendars = db.get_collection("calendars")
+    requests = []
+    # only documents that still have the list, a second run (or worker) finds nothing to do
+    for document in calendars.find({"all_events": {"$exists": True}}, {"all_events": 1}):
+        events = {event_config_key(event["name"]): event for event in document["all_events"]}
+        requests.append(UpdateOne({"_id": document["_id"]}, {"$set": {"events": events}, "$unset": {"all_events": ""}}))
+        if len(requests) >= batch_size:
+            calendars.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        calendars.bulk_write(requests, ordered=False)
+
+
+# Append new migrations with the next version number, never change already released ones.
+# Several workers may start at the same time, so every migration has to be idempotent.
+MIGRATIONS = [
+    Migration(1, "Indexes on calendars.token (unique), calendars.owner and users.usernameLower", _create_indexes),
+    Migration(2, "Event configurations of calendars keyed by event name (all_events -> events)", _key_events_by_name),
+]
+
+
+def get_schema_version(db: Database) -> int:
+    state = db.get_collection(MIGRATIONS_COLLECTION).find_one({"_id": SCHEMA_STATE_ID})
+    return state["version"] if state is not None else 0
+
+
+def run_migrations(db: Database, logger: logging.Logger = logging.getLogger(__name__)) -> int:
+    """Applies all migrations newer than the schema version stored in the database
+
+    Arguments:
+        db {Database} -- the database to migrate
+
+    Keyword Arguments:
+        logger {logging.Logger} -- (default: {logging.getLogger(__name__)})
+
+    Returns:
+        int -- the schema version of the database after the migrations
+    """
+    version = get_schema_version(db)
+    for migration in sorted(MIGRATIONS, key=lambda migration: migration.version):
+        if migration.version <= version:
+            continue
+
+        logger.info("Migrating database to version %s: %s", migration.version, migration.description)
+        migration.apply(db)
+        # $max keeps the highest version if several workers migrate at the same time
+        db.get_collection(MIGRATIONS_COLLECTION).update_one(
+            {"_id": SCHEMA_STATE_ID},
+            {"$max": {"version": migration.version}},
+            upsert=True,
+        )
+        version = migration.version
+
+    logger.info("Database schema version: %s", version)
+    return version
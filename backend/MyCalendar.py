@@ -1,42 +1,68 @@
+import copy
 import hashlib
-import requests
+from typing import Iterator
+
 from icalendar.cal import Calendar, Event
 
-from Lva import Lva
+from FeedCache import EventRenderCache
+from Lva import Lva, read_rooms
+from Metrics import timed
+from TissIcsParser import TissCalendar
 
 
 class MyCalendar:
-    def __init__(self, url: str, cal: Calendar):
+    def __init__(self, url: str, cal: Calendar, content_hash: str = None):
         self.url = url
         self.cal = cal
+        self.content_hash = content_hash
+        self._events_by_name: dict[str, list[Event]] | None = None
 
     @classmethod
-    def get_cal_from_url(cls, url: str):
+    def from_ical(cls, url: str, content: bytes):
         try:
-            req = requests.get(url, timeout=5)
-            if req.status_code == 200:
-                cal = Calendar.from_ical(req.content)
-                return cls(url, cal)
-        except Exception as e:
-            return None
-        return None
+            # fast path for the feeds TISS produces, anything unexpected is parsed by icalendar
+            cal = TissCalendar.from_ical(content)
+        except Exception:
+            # not only ValueError: icalendar's property parsers raise e.g. AttributeError on broken parameters
+            try:
+                cal = Calendar.from_ical(content)
+            except Exception:
+                return None
+        return cls(url, cal, hashlib.sha1(content).hexdigest())
+
+    def copy(self):
+        return MyCalendar(self.url, copy.deepcopy(self.cal), self.content_hash)
 
     def get_all_events(self) -> list[Event]:
         return [event for event in self.cal.subcomponents if event.name == "VEVENT"]
 
     def get_events_by_name(self, name: str) -> list[Event]:
-        return [event for event in self.cal.subcomponents if event.name == "VEVENT" and event.get("summary", "") == name]
+        return self._get_events_by_name().get(name, [])
 
     def get_distinct_events(self) -> list[str]:
-        return list(set([event.get("summary") for event in self.cal.subcomponents if event.name == "VEVENT"]))
+        return list(self._get_events_by_name().keys())
 
     def delete_events_by_name(self, name: str):
-        for event in self.cal.subcomponents[:]:
-            if event.name != "VEVENT":
-                continue
-
-            if event.get("summary", "") == name:
-                self.cal.subcomponents.remove(event)
+        self.delete_events_by_names({name})
+
+    def delete_events_by_names(self, names: set[str]):
+        if not names:
+            return
+
+        self.cal.subcomponents = [
+            event for event in self.cal.subcomponents if event.name != "VEVENT" or event.get("summary", "") not in names
+        ]
+        if self._events_by_name is not None:
+            for name in names:
+                self._events_by_name.pop(name, None)
+
+    def _get_events_by_name(self) -> dict[str, list[Event]]:
+        # Index of all events by their (original) summary, built once per parsed calendar
+        if self._events_by_name is None:
+            self._events_by_name = {}
+            for event in self.get_all_events():
+                self._events_by_name.setdefault(event.get("summary", ""), []).append(event)
+        return self._events_by_name
 
     def prettify_events_by_name(self, name, location_template, description_template, summary_template):
         # Format Properties:
@@ -65,31 +91,143 @@ class MyCalendar:
         # TODO:
         # Default Template (inserts the default template)
 
-        events = self.get_events_by_name(name)
-        for event in events:
-            lva = Lva.lva_from_ical_event(event)
-
-            location_format = location_template
-            lva.set_location(location_format)
-
-            desc_format = description_template
-            lva.set_description(desc_format)
-
-            # Summary needs to be set last!!!
-            summary_format = summary_template
-            lva.set_summary(summary_format)
+        # everything that only depends on the course is computed once for all its events
+        course_properties = Lva.course_properties_from_summary(name)
+        for event in self.get_events_by_name(name):
+            MyCalendar._prettify_event(event, location_template, description_template, summary_template, course_properties)
+
+        # summaries changed, the index has to be rebuilt
+        self._events_by_name = None
+
+    def prettify(
+        self,
+        remove_names: set[str],
+        templates: dict[str, tuple[str, str, str]],
+        render_cache: EventRenderCache = None,
+    ):
+        """Removes, prettifies and updates the UIDs of all events in a single pass over the calendar
+
+        Arguments:
+            remove_names {set[str]} -- names (summaries) of the events to remove
+            templates {dict[str, tuple[str, str, str]]} -- maps names of events to prettify to their
+                (location, description, summary) templates
+
+        Keyword Arguments:
+            render_cache {EventRenderCache} -- cache for the rendered properties of single events (default: {None})
+        """
+        with timed("prettify"):
+            self.delete_events_by_names(remove_names)
+
+            courses = {}
+            # rendered events contain room data, they are outdated once TU-Rooms.csv changes
+            rooms_version = read_rooms().version if render_cache is not None else None
+            for event in self.get_all_events():
+                name = event.get("summary", "")
+                event_templates = templates.get(name)
+
+                if render_cache is not None:
+                    cache_key = (hashlib.sha1(event.to_ical()).digest(), event_templates, rooms_version)
+                    if (rendered := render_cache.get(cache_key)) is not None:
+                        MyCalendar._apply_rendered_event(event, rendered)
+                        continue
+
+                if event_templates is not None:
+                    if name not in courses:
+                        courses[name] = Lva.course_properties_from_summary(name)
+                    MyCalendar._prettify_event(event, *event_templates, courses[name])
+                MyCalendar._update_event_uid(event)
+
+                if render_cache is not None:
+                    render_cache.put(cache_key, MyCalendar._get_rendered_event(event, event_templates is not None))
+
+            self._events_by_name = None
+
+    @staticmethod
+    def _get_rendered_event(event: Event, prettified: bool) -> tuple:
+        if not prettified:
+            return (str(event["UID"]),)
+
+        return (
+            str(event["UID"]),
+            str(event["summary"]),
+            str(event["location"]),
+            str(event["description"]),
+            event["description"].params["ALTREP"],
+        )
+
+    @staticmethod
+    def _apply_rendered_event(event: Event, rendered: tuple):
+        if len(rendered) > 1:
+            uid, summary, location, description, altrep = rendered
+            event["location"] = location
+            del event["description"]
+            event.add("description", description, {"altrep": altrep})
+            event["summary"] = summary
+        event["UID"] = rendered[0]
+
+    @staticmethod
+    def _prettify_event(
+        event: Event, location_template: str, description_template: str, summary_template: str, course_properties: dict = None
+    ):
+        lva = Lva.lva_from_ical_event(event, course_properties)
+
+        location_format = location_template
+        lva.set_location(location_format)
+
+        desc_format = description_template
+        lva.set_description(desc_format)
+
+        # Summary needs to be set last!!!
+        summary_format = summary_template
+        lva.set_summary(summary_format)
 
     def update_event_uids(self):
         for event in self.get_all_events():
-            nice = (
-                str(event.get("SUMMARY", ""))
-                + str(event.get("DESCRIPTION", ""))
-                + str(event.get("DTSTART", "").dt.strftime("%d%m%Y %H%M"))
-                + str(event.get("DTEND", "").dt.strftime("%d%m%Y %H%M"))
-                + str(event.get("LOCATION", ""))
-            )
-            hash = hashlib.sha1(nice.encode()).hexdigest()
-            event["UID"] = hash
+            MyCalendar._update_event_uid(event)
+
+    @staticmethod
+    def _update_event_uid(event: Event):
+        nice = (
+            str(event.get("SUMMARY", ""))
+            + str(event.get("DESCRIPTION", ""))
+            + str(event.get("DTSTART", "").dt.strftime("%d%m%Y %H%M"))
+            + str(event.get("DTEND", "").dt.strftime("%d%m%Y %H%M"))
+            + str(event.get("LOCATION", ""))
+        )
+        hash = hashlib.sha1(nice.encode()).hexdigest()
+        event["UID"] = hash
 
     def to_ical(self):
-        return self.cal.to_ical().decode("utf-8")
+        return b"".join(self.iter_ical()).decode("utf-8")
+
+    def iter_ical(self, chunk_size: int = 65536) -> Iterator[bytes]:
+        """Serializes the calendar piece by piece: the VCALENDAR header, the events and the footer.
+        Events are grouped into chunks of about chunk_size bytes, so the whole calendar never
+        has to exist as one string.
+
+        Keyword Arguments:
+            chunk_size {int} -- minimum size of the yielded chunks in bytes (default: {65536})
+
+        Yields:
+            bytes -- the next chunk of the serialized calendar
+        """
+        if isinstance(self.cal, TissCalendar):
+            header, footer = self.cal.header, self.cal.footer
+        else:
+            *header_items, footer_item = self.cal.property_items(recursive=False)
+            header = b"".join(self.cal.content_line(name, value).to_ical() + b"\r\n" for name, value in header_items)
+            footer = self.cal.content_line(*footer_item).to_ical() + b"\r\n"
+
+        buffer = [header]
+        buffered = len(header)
+        for component in self.cal.subcomponents:
+            data = component.to_ical()
+            buffer.append(data)
+            buffered += len(data)
+            if buffered >= chunk_size:
+                yield b"".join(buffer)
+                buffer = []
+                buffered = 0
+
+        buffer.append(footer)
+        yield b"".join(buffer)
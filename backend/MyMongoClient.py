@@ -1,27 +1,112 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Awaitable, Callable, TypeVar
+
 import pymongo
 from pymongo import MongoClient
+from pymongo.client_session import ClientSession
+from pymongo.collection import Collection
+from pymongo.topology_description import TOPOLOGY_TYPE
+
+from RequestProfiler import run_profiled
+
+T = TypeVar("T")
+
+
+class AsyncCollection:
+    """Awaitable version of the pymongo Collection methods the handlers use. The blocking pymongo
+    calls run in a thread pool (like motor does), so a database round trip does not block the event loop.
+    """
+
+    def __init__(self, collection: Collection, executor: ThreadPoolExecutor | None = None):
+        self.collection = collection
+        self.executor = executor
+
+    @property
+    def full_name(self) -> str:
+        return self.collection.full_name
+
+    async def _run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        # unlike asyncio.to_thread, run_in_executor does not pass on the context (needed by run_profiled)
+        call = partial(contextvars.copy_context().run, run_profiled, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def find_one(self, *args, **kwargs) -> dict | None:
+        return await self._run(self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs) -> list[dict]:
+        # the cursor is read completely in the thread pool, every document is in the returned list
+        return await self._run(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run(self.collection.insert_one, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run(self.collection.update_one, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run(self.collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run(self.collection.delete_many, *args, **kwargs)
 
 
 class MyMongoClient(MongoClient):
-    def __init__(self, connection_string, db_name, collection, *args, **kwargs):
+    """Process wide MongoDB client. It is created once at startup and its connection pool
+    is shared by all handlers, which only get the collections they work on.
+    """
+
+    def __init__(self, connection_string, db_name, *args, **kwargs):
         super().__init__(connection_string, *args, **kwargs)
         self.db = self.get_database(db_name)
-        self.collection = self.db.get_collection(collection)
-
-    def find_one(self, *args, **kwargs):
-        return self.collection.find_one(*args, **kwargs)
-
-    def delete_one(self, *args, **kwargs) -> pymongo.results.DeleteResult:
-        return self.collection.delete_one(*args, **kwargs)
-
-    def insert_one(self, *args, **kwargs) -> pymongo.results.InsertOneResult:
-        return self.collection.insert_one(*args, **kwargs)
-    
-    def update_one(self, *args, **kwargs) -> pymongo.results.UpdateResult:
-        return self.collection.update_one(*args, **kwargs)
-    
-    def find(self, *args, **kwargs):
-        return self.collection.find(*args, **kwargs)
+        # one thread per pooled connection, more threads would only wait for a connection
+        self.executor = ThreadPoolExecutor(max_workers=kwargs.get("maxPoolSize") or 100, thread_name_prefix="mongo")
+
+    def get_collection(self, collection: str) -> Collection:
+        return self.db.get_collection(collection)
+
+    def get_async_collection(self, collection: str) -> AsyncCollection:
+        return AsyncCollection(self.get_collection(collection), self.executor)
+
+    def supports_transactions(self) -> bool:
+        # transactions need a replica set or a sharded cluster, a standalone server rejects them
+        return self.topology_description.topology_type in (
+            TOPOLOGY_TYPE.ReplicaSetWithPrimary,
+            TOPOLOGY_TYPE.Sharded,
+            TOPOLOGY_TYPE.LoadBalanced,
+        )
+
+    async def run_in_transaction(self, callback: Callable[[ClientSession | None], Awaitable[T]]) -> T:
+        """Runs callback in a transaction if the deployment supports them, otherwise without one.
+
+        Arguments:
+            callback {Callable[[ClientSession | None], Awaitable[T]]} -- gets the session to pass to all operations (None without transaction)
+
+        Returns:
+            T -- whatever callback returns
+        """
+        if not self.supports_transactions():
+            return await callback(None)
+
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(self.executor, self.start_session)
+        try:
+            session.start_transaction()
+            try:
+                result = await callback(session)
+            except BaseException:
+                await loop.run_in_executor(self.executor, session.abort_transaction)
+                raise
+            await loop.run_in_executor(self.executor, session.commit_transaction)
+            return result
+        finally:
+            session.end_session()
+
+    def close(self):
+        super().close()
+        self.executor.shutdown(wait=False)
 
     def check_connection(self) -> bool:
         try:
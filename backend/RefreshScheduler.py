@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+
+import redis
+
+from models.TissCalModels import TissCalDB
+from TissCalHandler import TissCalHandler
+
+
+class RefreshStats:
+    __slots__ = ("urls_refreshed", "calendars_refreshed", "failures", "duration")
+
+    def __init__(self):
+        self.urls_refreshed = 0
+        self.calendars_refreshed = 0
+        self.failures = 0
+        self.duration = 0.0
+
+    def dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class RefreshScheduler:
+    """Periodically refreshes every distinct TISS feed and pre-renders all calendars that use it,
+    so subscriber requests can be answered from the PrerenderedFeedStore.
+
+    If several workers run a scheduler, only the one holding the lock in redis does the work.
+    """
+
+    LOCK_KEY = "tisscal:refresh-scheduler"
+
+    def __init__(
+        self,
+        logger: logging.Logger = logging.getLogger(__name__),
+        tiss_cal_handler: TissCalHandler = None,
+        redis_pool: redis.ConnectionPool = None,
+        interval: int = 900,
+        jitter: float = 0.1,
+        concurrency: int = 4,
+    ):
+        self.logger = logger
+        self.tiss_cal_handler = tiss_cal_handler
+        self.redis_pool = redis_pool
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.last_stats: RefreshStats | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self.logger.info("Starting refresh scheduler (worker %s)", self.worker_id)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._release_lock()
+
+    async def _run(self):
+        while True:
+            try:
+                if self._acquire_lock():
+                    await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.exception("Refresh scheduler run failed: %s", e)
+
+            await asyncio.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def run_once(self) -> RefreshStats:
+        stats = RefreshStats()
+        start = time.monotonic()
+
+        calendars_by_url: dict[str, list[TissCalDB]] = {}
+        for cal_data in await self.tiss_cal_handler.get_all_calendars():
+            calendars_by_url.setdefault(cal_data.url, []).append(cal_data)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh_url(url: str, calendars: list[TissCalDB]):
+            async with semaphore:
+                try:
+                    cal = await self.tiss_cal_handler.upstream_cache.get_calendar(url, max_age=0)
+                except Exception as e:
+                    # one broken feed must not end the whole run
+                    self.logger.warning("Refresh scheduler: fetching %s failed: %s", url, e)
+                    cal = None
+                if cal is None:
+                    self.logger.info("Refresh scheduler: fetching %s failed", url)
+                    stats.failures += len(calendars)
+                    return
+                stats.urls_refreshed += 1
+
+                for cal_data in calendars:
+                    try:
+                        merged_cal_data = await self.tiss_cal_handler.merge_calendar_events(cal_data, cal)
+                        if merged_cal_data is None:
+                            feed = None
+                        else:
+                            feed = await asyncio.to_thread(self.tiss_cal_handler.render_feed, merged_cal_data, cal)
+                    except Exception as e:
+                        self.logger.warning("Refresh scheduler: rendering calendar %s failed: %s", cal_data.token, e)
+                        feed = None
+
+                    if feed is None:
+                        stats.failures += 1
+                    else:
+                        stats.calendars_refreshed += 1
+
+        urls = list(calendars_by_url.items())
+        random.shuffle(urls)
+        await asyncio.gather(*(refresh_url(url, calendars) for url, calendars in urls))
+
+        stats.duration = time.monotonic() - start
+        self.last_stats = stats
+        self.logger.info(
+            "Refresh scheduler: refreshed %s calendars from %s feeds in %.2fs, %s failures",
+            stats.calendars_refreshed,
+            stats.urls_refreshed,
+            stats.duration,
+            stats.failures,
+        )
+        return stats
+
+    def _acquire_lock(self) -> bool:
+        """Takes (or extends) the scheduler lock in redis, so only one worker refreshes at a time"""
+        if self.redis_pool is None:
+            return True
+
+        client = redis.Redis(connection_pool=self.redis_pool)
+        ttl = int(self.interval * (1 + self.jitter)) * 2
+        if client.set(self.LOCK_KEY, self.worker_id, nx=True, ex=ttl):
+            return True
+        if client.get(self.LOCK_KEY) == self.worker_id:
+            client.expire(self.LOCK_KEY, ttl)
+            return True
+        return False
+
+    def _release_lock(self):
+        if self.redis_pool is None:
+            return
+
+        client = redis.Redis(connection_pool=self.redis_pool)
+        if client.get(self.LOCK_KEY) == self.worker_id:
+            client.delete(self.LOCK_KEY)
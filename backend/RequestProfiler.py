@@ -0,0 +1,141 @@
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, TypeVar
+
+import redis
+
+T = TypeVar("T")
+
+# profilers of the request being profiled in the current context, one per thread that worked on it
+_active_profilers: ContextVar[list[cProfile.Profile] | None] = ContextVar("active_profilers", default=None)
+
+
+def run_profiled(func: Callable[..., T], *args, **kwargs) -> T:
+    """Calls func, for a request that is being profiled with a profiler of its own thread. cProfile only
+    sees the thread it was enabled in, so work moved off the event loop (asyncio.to_thread, the mongo
+    thread pool) has to be called through this to be part of the profile.
+    """
+    profilers = _active_profilers.get()
+    if profilers is None:
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is already active on this thread
+        return func(*args, **kwargs)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profilers.append(profiler)
+
+
+class RequestProfiler:
+    """Profiles single requests with cProfile when they carry the profiling secret in the X-Profile
+    header (not as query parameter, it would end up in the access log). Disabled if no secret is set.
+
+    At most one request per min_interval seconds is profiled (across all workers sharing the redis).
+    The profile covers the event loop while the request is handled and the work of the request in
+    other threads (parsing, rendering, mongo and redis calls) that is called through run_profiled.
+    """
+
+    HEADER = "X-Profile"
+    RATE_LIMIT_KEY = "tisscal:request-profiler"
+
+    def __init__(
+        self,
+        logger: logging.Logger = logging.getLogger(__name__),
+        redis_pool: redis.ConnectionPool = None,
+        secret: str | None = None,
+        output_dir: str = "profiles",
+        min_interval: int = 60,
+    ):
+        self.logger = logger
+        self.redis_pool = redis_pool
+        self.secret = secret
+        self.output_dir = output_dir
+        self.min_interval = min_interval
+
+        self._last_profile = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.secret)
+
+    def is_requested(self, headers: dict) -> bool:
+        if not self.enabled:
+            return False
+
+        value = headers.get(self.HEADER)
+        return value is not None and hmac.compare_digest(value.encode(), self.secret.encode())
+
+    @contextmanager
+    def profile(self, name: str):
+        """Profiles the block and writes the stats to <output_dir>/<name>-<timestamp>.prof
+
+        Arguments:
+            name {str} -- name of the profile, e.g. the calendar token
+
+        Yields:
+            str | None -- path of the profile, None if the rate limit was hit
+        """
+        if not self._acquire_slot():
+            self.logger.info("Profiling of %s skipped, rate limit of one profile per %ss", name, self.min_interval)
+            yield None
+            return
+
+        safe_name = re.sub(r"[^A-Za-z0-9_-]", "_", name)[:64]
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        path = os.path.join(self.output_dir, f"{safe_name}-{timestamp}.prof")
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # another profiler is already active on this thread
+            self.logger.warning("Profiling of %s not possible: %s", name, e)
+            yield None
+            return
+
+        profilers = [profiler]
+        context_token = _active_profilers.set(profilers)
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            _active_profilers.reset(context_token)
+            # one profile for the event loop and all threads that worked on the request
+            stats = pstats.Stats(profiler)
+            for thread_profiler in profilers[1:]:
+                stats.add(thread_profiler)
+            os.makedirs(self.output_dir, exist_ok=True)
+            stats.dump_stats(path)
+            self.logger.warning("Profile of %s written to %s", name, path)
+
+    def _acquire_slot(self) -> bool:
+        if self.min_interval <= 0:
+            return True
+
+        if self.redis_pool is not None:
+            client = redis.Redis(connection_pool=self.redis_pool)
+            return bool(client.set(self.RATE_LIMIT_KEY, os.getpid(), nx=True, ex=self.min_interval))
+
+        with self._lock:
+            now = time.monotonic()
+            if self._last_profile and now - self._last_profile < self.min_interval:
+                return False
+            self._last_profile = now
+            return True
@@ -1,13 +1,30 @@
+import asyncio
+import hashlib
+import json
 import logging
 import random
 import string
+from typing import Iterator
 
 from bson.objectid import ObjectId
+from pymongo.client_session import ClientSession
+from pymongo.errors import DuplicateKeyError
 
-from Lva import Lva
-from models.TissCalModels import _TissCalEventModel, TissCalDB, TissCalDBCreate
+from FeedCache import EventRenderCache, FeedCache, PrerenderedFeedStore, RenderedFeed
+from Lva import Lva, read_rooms
+from Metrics import CACHE_LOOKUPS, timed
+from models.TissCalModels import (
+    _TissCalEventModel,
+    _TissCalSummaryModel,
+    TissCalDB,
+    TissCalDBCreate,
+    calendar_to_document,
+    event_config_key,
+)
 from MyCalendar import MyCalendar
-from MyMongoClient import MyMongoClient
+from MyMongoClient import AsyncCollection
+from RequestProfiler import run_profiled
+from UpstreamCache import UpstreamCache
 from UserHandler import UserHandler
 
 
@@ -15,150 +32,265 @@ class TissCalHandler:
     def __init__(
         self,
         logger: logging.Logger = logging.getLogger(__name__),
-        connection_string: str = "mongodb://localhost:27017",
-        db_name: str = "project",
-        tiss_cal_collection: str = "calendars",
+        collection: AsyncCollection = None,
         user_handler: UserHandler = None,
+        feed_cache: FeedCache = None,
+        upstream_cache: UpstreamCache = None,
+        feed_store: PrerenderedFeedStore = None,
+        event_cache: EventRenderCache = None,
     ):
         self.logger = logger
 
-        self.connection_string = connection_string
-        self.db_name = db_name
-        self.tiss_cal_collection = tiss_cal_collection
+        self.collection = collection
 
         self.user_handler = user_handler
+        self.feed_cache = feed_cache
+        self.upstream_cache = upstream_cache if upstream_cache is not None else UpstreamCache(logger=logger, max_age=0)
+        self.feed_store = feed_store
+        self.event_cache = event_cache
 
-        with self._get_mongo_connection() as client:
-            if not client.check_connection():
-                raise Exception("MongoDB connection failed")
-
-    def create_new_calendar(self, url: str, name: str, owner: str) -> TissCalDB | None:
+    async def create_new_calendar(self, url: str, name: str, owner: str) -> TissCalDB | None:
         # TODO: check if Name is already taken (only for the owner)
-        cal = MyCalendar.get_cal_from_url(url)
+        cal = await self.upstream_cache.get_calendar(url)
         if cal is None:
             return None
 
-        if self.user_handler.get_user_by_uid(owner) is None:
+        if await self.user_handler.get_user_by_uid(owner) is None:
             return None
 
-        with self._get_mongo_connection() as client:
-            data = TissCalDBCreate(
-                url=url,
-                name=name,
-                owner=owner,
-                token=TissCalHandler.generate_calendar_token(),
-                all_events=[
-                    {
-                        "name": event_name,
-                        "will_prettify": Lva.is_lva_str(event_name),
-                        "will_remove": False,
-                        "is_lva": Lva.is_lva_str(event_name),
-                        "summaryFormat": None,
-                        "locationFormat": None,
-                        "descriptionFormat": None,
-                    }
-                    for event_name in cal.get_distinct_events()
-                ],
-            ).dict()
-            result = client.insert_one(data)
-
-        return TissCalDB(uid=result.inserted_id, **data)
-
-    def update_calendar(self, calendar: TissCalDB) -> TissCalDB | None:
-        with self._get_mongo_connection() as client:
-            result = client.update_one({"_id": calendar.id}, {"$set": calendar.dict(exclude={"id"})})
-            if result.matched_count == 0:
-                return None
+        data = TissCalDBCreate(
+            url=url,
+            name=name,
+            owner=owner,
+            token=TissCalHandler.generate_calendar_token(),
+            all_events=[
+                {
+                    "name": event_name,
+                    "will_prettify": Lva.is_lva_str(event_name),
+                    "will_remove": False,
+                    "is_lva": Lva.is_lva_str(event_name),
+                    "summaryFormat": None,
+                    "locationFormat": None,
+                    "descriptionFormat": None,
+                }
+                for event_name in cal.get_distinct_events()
+            ],
+        ).dict()
+        document = calendar_to_document(data)
+        if not await self.insert_calendar(document):
+            return None
+
+        return TissCalDB.from_document(document)
+
+    async def insert_calendar(self, data: dict, attempts: int = 5) -> bool:
+        # calendars.token has a unique index (see Migrations.py), a token that is already taken is replaced
+        for _ in range(attempts):
+            try:
+                await self.collection.insert_one(data)
+                return True
+            except DuplicateKeyError:
+                self.logger.warning("Calendar token %s already exists, generating a new one", data["token"])
+                data.pop("_id", None)
+                data["token"] = TissCalHandler.generate_calendar_token()
+
+        self.logger.error("Could not insert calendar, no unique token after %s attempts", attempts)
+        return False
+
+    async def update_calendar(self, calendar: TissCalDB) -> TissCalDB | None:
+        result = await self.collection.update_one({"_id": calendar.id}, {"$set": calendar_to_document(calendar.dict(exclude={"id"}))})
+        if result.matched_count == 0:
+            return None
 
         return calendar
 
-    def delete_calendar_by_token(self, token: str) -> bool:
-        with self._get_mongo_connection() as client:
-            result = client.delete_one({"token": token})
-            return result.deleted_count == 1
+    async def delete_calendar_by_token(self, token: str) -> bool:
+        result = await self.collection.delete_one({"token": token})
+        return result.deleted_count == 1
+
+    async def delete_calendars_by_owner(self, uid: str, session: ClientSession = None) -> int:
+        result = await self.collection.delete_many({"owner": uid}, session=session)
+        return result.deleted_count
 
-    def get_calendar_by_id(self, id: str) -> TissCalDB | None:
-        with self._get_mongo_connection() as client:
-            data = client.find_one({"_id": ObjectId(id)})
-            return TissCalDB(**data) if data is not None else None
+    async def get_calendar_by_id(self, id: str) -> TissCalDB | None:
+        data = await self.collection.find_one({"_id": ObjectId(id)})
+        return TissCalDB.from_document(data) if data is not None else None
+
+    async def get_calendar_by_token(self, token: str) -> TissCalDB | None:
+        data = await self.collection.find_one({"token": token})
+        return TissCalDB.from_document(data) if data is not None else None
+
+    async def get_all_calendars(self) -> list[TissCalDB]:
+        return [TissCalDB.from_document(d) for d in await self.collection.find({})]
+
+    async def get_calendars_by_owner(self, uid: str) -> list[TissCalDB]:
+        data = await self.collection.find({"owner": uid})
+        return [TissCalDB.from_document(d) for d in data]
+
+    async def get_calendar_summaries_by_owner(
+        self, uid: str, limit: int = 100, cursor: str | None = None
+    ) -> tuple[list[_TissCalSummaryModel], str | None] | None:
+        """Returns name, url and token of the calendars of a user, one page at a time and without
+        loading the event configurations.
+
+        Arguments:
+            uid {str} -- id of the owner
+
+        Keyword Arguments:
+            limit {int} -- maximum number of calendars to return (default: {100})
+            cursor {str | None} -- next_cursor of the previous page, None for the first page (default: {None})
+
+        Returns:
+            tuple[list[_TissCalSummaryModel], str | None] | None -- the calendars and the cursor of the
+                next page (None if this is the last page), None if the cursor is invalid
+        """
+        query = {"owner": uid}
+        if cursor is not None:
+            if not ObjectId.is_valid(cursor):
+                return None
+            query["_id"] = {"$gt": ObjectId(cursor)}
 
-    def get_calendar_by_token(self, token: str) -> TissCalDB | None:
-        with self._get_mongo_connection() as client:
-            data = client.find_one({"token": token})
-            return TissCalDB(**data) if data is not None else None
+        # one more than requested, to know if there is a next page
+        data = await self.collection.find(query, {"url": 1, "name": 1, "token": 1}, sort=[("_id", 1)], limit=limit + 1)
+        next_cursor = str(data[limit - 1]["_id"]) if len(data) > limit else None
+        return [_TissCalSummaryModel(**d) for d in data[:limit]], next_cursor
 
-    def get_calendars_by_owner(self, uid: str) -> list[TissCalDB]:
-        with self._get_mongo_connection() as client:
-            data = client.find({"owner": uid})
-            return [TissCalDB(**d) for d in data]
+    async def prettify_calendar(self, token: str) -> str | None:
+        feed = await self.get_feed(token)
+        return feed.body if feed is not None else None
 
-    def prettify_calendar(self, token: str) -> str | None:
-        cal_data = self.update_calendar_from_source(token)
+    async def get_feed(self, token: str) -> RenderedFeed | None:
+        with timed("mongo"):
+            cal_data = await self.get_calendar_by_token(token)
         if cal_data is None:
             return None
 
-        cal = MyCalendar.get_cal_from_url(cal_data.url)
+        if self.feed_store is not None:
+            config_version = TissCalHandler.get_config_version(cal_data)
+            # HGETALL of the whole feed body, it must not block the event loop
+            with timed("redis"):
+                feed = await asyncio.to_thread(run_profiled, self.feed_store.get, token, config_version)
+            CACHE_LOOKUPS.inc(cache="prerendered", result="hit" if feed is not None else "miss")
+            if feed is not None:
+                self.logger.debug("Serving pre-rendered feed for calendar %s", token)
+                return feed
+
+        cal = await self.upstream_cache.get_calendar(cal_data.url)
         if cal is None:
             return None
 
-        for event in cal_data.all_events:
-            if not event.will_remove:
-                continue
-            cal.delete_events_by_name(event.name)
+        cal_data = await self.merge_calendar_events(cal_data, cal)
+        if cal_data is None:
+            return None
+
+        # rendering is CPU bound, it must not block the event loop
+        return await asyncio.to_thread(run_profiled, self.render_feed, cal_data, cal)
 
-        for event in cal_data.all_events:
+    def render_feed(self, cal_data: TissCalDB, cal: MyCalendar) -> RenderedFeed:
+        """Renders (or takes from the caches) the formatted feed, cal_data has to be merged with cal already"""
+        config_version = TissCalHandler.get_config_version(cal_data)
+        # the rendered feed contains room data, a changed TU-Rooms.csv means rendering it again
+        cache_key = (cal.content_hash, config_version, read_rooms().version)
+        feed = self.feed_cache.get(cache_key) if self.feed_cache is not None else None
+        if self.feed_cache is not None:
+            CACHE_LOOKUPS.inc(cache="feed", result="hit" if feed is not None else "miss")
+        if feed is None:
+            # the upstream calendar is shared, rendering works on a private copy
+            with timed("copy"):
+                cal = cal.copy()
+            chunks = self.render_calendar(cal_data, cal)
+            with timed("serialize"):
+                feed = RenderedFeed(chunks)
+            if self.feed_cache is not None:
+                self.feed_cache.put(cache_key, feed)
+        else:
+            self.logger.debug("Feed cache hit for calendar %s", cal_data.token)
+
+        if self.feed_store is not None:
+            with timed("redis"):
+                self.feed_store.put(cal_data.token, config_version, feed)
+        return feed
+
+    def render_calendar(self, cal_data: TissCalDB, cal: MyCalendar) -> Iterator[bytes]:
+        default_template = cal_data.default_template
+        remove_names = set()
+        templates = {}
+        for name, event in cal_data.events_by_name.items():
+            if event.will_remove:
+                remove_names.add(name)
             if not (event.is_lva and event.will_prettify):
                 continue
 
             location_template = (
-                event.locationFormat if event.locationFormat is not None else cal_data.default_template.defaultLocationFormat
+                event.locationFormat if event.locationFormat is not None else default_template.defaultLocationFormat
             )
             description_template = (
                 event.descriptionFormat
                 if event.descriptionFormat is not None
-                else cal_data.default_template.defaultDescriptionFormat
+                else default_template.defaultDescriptionFormat
             )
             summary_template = (
-                event.summaryFormat if event.summaryFormat is not None else cal_data.default_template.defaultSummaryFormat
+                event.summaryFormat if event.summaryFormat is not None else default_template.defaultSummaryFormat
             )
-            cal.prettify_events_by_name(event.name, location_template, description_template, summary_template)
+            templates[name] = (location_template, description_template, summary_template)
 
-        cal.update_event_uids()
-        return cal.to_ical()
+        cal.prettify(remove_names, templates, self.event_cache)
+        return cal.iter_ical()
 
-    def update_calendar_from_source(self, token: str) -> TissCalDB | None:
-        old_cal_data = self.get_calendar_by_token(token)
+    async def update_calendar_from_source(self, token: str) -> TissCalDB | None:
+        old_cal_data = await self.get_calendar_by_token(token)
         if old_cal_data is None:
             return None
 
-        new_cal = MyCalendar.get_cal_from_url(old_cal_data.url)
+        new_cal = await self.upstream_cache.get_calendar(old_cal_data.url)
         if new_cal is None:
             return None
 
-        old_cal_event_names = [event.name for event in old_cal_data.all_events]
-        for event_name in new_cal.get_distinct_events():
-            if event_name in old_cal_event_names:
-                continue
-            old_cal_data.all_events.append(
-                _TissCalEventModel(
-                    name=event_name,
-                    will_prettify=Lva.is_lva_str(event_name),
-                    will_remove=False,
-                    is_lva=Lva.is_lva_str(event_name),
-                    summaryFormat=None,
-                    locationFormat=None,
-                    descriptionFormat=None,
-                )
+        return await self.merge_calendar_events(old_cal_data, new_cal)
+
+    async def merge_calendar_events(self, old_cal_data: TissCalDB, new_cal: MyCalendar) -> TissCalDB | None:
+        # set difference, linear in the number of event names
+        new_event_names = set(new_cal.get_distinct_events()) - old_cal_data.events_by_name.keys()
+        new_events = [
+            _TissCalEventModel(
+                name=event_name,
+                will_prettify=Lva.is_lva_str(event_name),
+                will_remove=False,
+                is_lva=Lva.is_lva_str(event_name),
+                summaryFormat=None,
+                locationFormat=None,
+                descriptionFormat=None,
             )
+            for event_name in sorted(new_event_names)
+        ]
 
-        return self.update_calendar(old_cal_data)
+        # nothing new in the feed, nothing to write
+        if not new_events:
+            return old_cal_data
+
+        if not await self.add_calendar_events(old_cal_data, new_events):
+            return None
+
+        old_cal_data.all_events.extend(new_events)
+        return old_cal_data
+
+    async def add_calendar_events(self, calendar: TissCalDB, events: list[_TissCalEventModel]) -> bool:
+        with timed("mongo"):
+            result = await self.collection.update_one(
+                {"_id": calendar.id},
+                # one field per event name, an event that was added concurrently is just set again
+                {"$set": {f"events.{event_config_key(event.name)}": event.dict() for event in events}},
+            )
+        return result.matched_count == 1
+
+    @staticmethod
+    def get_config_version(cal_data: TissCalDB) -> str:
+        # the url is part of it, a feed rendered from the old TISS calendar must not be served after a change
+        config = cal_data.dict(include={"url", "all_events", "default_template"})
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
 
     @staticmethod
     def generate_calendar_token(length=30) -> str:
-        # TODO: check if token is unique
+        # uniqueness is enforced by the database, see insert_calendar
         characters = string.ascii_letters + string.digits
         token = "".join(random.choice(characters) for i in range(length))
         return token
-
-    def _get_mongo_connection(self):
-        return MyMongoClient(self.connection_string, self.db_name, self.tiss_cal_collection)
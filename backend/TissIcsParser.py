@@ -0,0 +1,229 @@
+import re
+
+import pytz
+from icalendar.parser import Contentline, Parameters, escape_string, unescape_string
+from icalendar.cal import types_factory
+
+# Only lines starting like a property ("NAME:" or "NAME;") are accepted, anything else is left to icalendar
+PROPERTY_LINE_PATTERN = re.compile(r"^[A-Za-z0-9-]+[;:]")
+DATETIME_PROPERTIES = ("DTSTART", "DTEND", "RECURRENCE-ID", "DUE", "FREEBUSY", "RDATE", "EXDATE")
+
+
+def split_property_line(line: str) -> tuple[str, Parameters, str]:
+    """Same as icalendar's Contentline.parts, with a shortcut for the simple lines TISS writes"""
+    colon = line.find(":")
+    head = line[:colon]
+    if colon <= 0 or '"' in head or "\\" in head or "," in head:
+        return Contentline(line).parts()
+
+    name, *raw_params = head.split(";")
+    params = Parameters()
+    for raw_param in raw_params:
+        key, sep, value = raw_param.partition("=")
+        if not sep:
+            return Contentline(line).parts()
+        params[key] = value
+    return name, params, unescape_string(escape_string(line[colon + 1 :]))
+
+
+def decode_property(line: str):
+    """Decodes one unfolded content line into an icalendar property value, the same way
+    icalendar.Component.from_ical does it.
+    """
+    name, params, vals = split_property_line(line)
+    name = name.upper()
+    factory = types_factory.for_property(name)
+    if name in DATETIME_PROPERTIES and "TZID" in params:
+        value = factory(factory.from_ical(vals, params["TZID"]))
+    else:
+        value = factory(factory.from_ical(vals))
+    value.params = params
+    return value
+
+
+def encode_property(name: str, value, parameters: dict = None):
+    if isinstance(value, types_factory.all_types):
+        return value
+
+    value = types_factory.for_property(name)(value)
+    if parameters:
+        value.params = Parameters(parameters)
+    return value
+
+
+class RawComponent:
+    """Any component other than VEVENT (e.g. VTIMEZONE), kept as the original text"""
+
+    __slots__ = ("name", "raw")
+
+    def __init__(self, name: str, raw: str):
+        self.name = name
+        self.raw = raw
+
+    def get(self, name, default=None):
+        return default
+
+    def to_ical(self) -> bytes:
+        return self.raw.encode("utf-8")
+
+
+class TissEvent:
+    """A VEVENT that only decodes the properties that are actually read. Properties that are
+    never changed are written back exactly as they came from TISS.
+
+    Supports the part of the icalendar.Event interface used by MyCalendar and Lva.
+    """
+
+    __slots__ = ("_raw", "_values")
+
+    name = "VEVENT"
+
+    def __init__(self, raw: dict[str, str]):
+        # NAME -> original (folded) lines of the property, None once the property was changed
+        self._raw = raw
+        self._values = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name.upper() in self._raw
+
+    def __getitem__(self, name: str):
+        key = name.upper()
+        if key not in self._values:
+            raw = self._raw[key]
+            self._values[key] = decode_property(TissCalendar.unfold(raw))
+        return self._values[key]
+
+    def get(self, name: str, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name: str, value):
+        key = name.upper()
+        self._raw[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, name: str):
+        key = name.upper()
+        del self._raw[key]
+        self._values.pop(key, None)
+
+    def add(self, name: str, value, parameters: dict = None):
+        if name in self:
+            raise ValueError(f"Property {name} already exists")
+        self[name] = encode_property(name.upper(), value, parameters)
+
+    def to_ical(self) -> bytes:
+        lines = ["BEGIN:VEVENT\r\n"]
+        for key, raw in self._raw.items():
+            if raw is not None:
+                lines.append(raw)
+                continue
+            value = self._values[key]
+            params = getattr(value, "params", Parameters())
+            lines.append(Contentline.from_parts(key, params, value).to_ical().decode("utf-8") + "\r\n")
+        lines.append("END:VEVENT\r\n")
+        return "".join(lines).encode("utf-8")
+
+
+class TissCalendar:
+    """Lightweight replacement for icalendar.Calendar for the feeds TISS produces.
+    from_ical raises a ValueError for everything it does not expect, callers should then
+    fall back to icalendar.Calendar.from_ical.
+    """
+
+    __slots__ = ("header", "subcomponents")
+
+    footer = b"END:VCALENDAR\r\n"
+
+    def __init__(self, header: bytes, subcomponents: list):
+        self.header = header
+        self.subcomponents = subcomponents
+
+    def to_ical(self) -> bytes:
+        return self.header + b"".join(component.to_ical() for component in self.subcomponents) + self.footer
+
+    @staticmethod
+    def unfold(raw: str) -> str:
+        return raw.rstrip("\r\n").replace("\r\n ", "").replace("\r\n\t", "")
+
+    @classmethod
+    def from_ical(cls, content: bytes) -> "TissCalendar":
+        text = content.decode("utf-8")
+        if not text.startswith("BEGIN:VCALENDAR\r\n"):
+            raise ValueError("Not a VCALENDAR with CRLF line endings")
+
+        # group the physical lines into (folded) content lines
+        content_lines = []
+        for line in text.split("\r\n"):
+            if line[:1] in (" ", "\t"):
+                if not content_lines:
+                    raise ValueError("Continuation line without content line")
+                content_lines[-1] += "\r\n" + line
+            elif line:
+                content_lines.append(line)
+
+        if content_lines[-1] != "END:VCALENDAR":
+            raise ValueError("Calendar does not end with END:VCALENDAR")
+
+        header = []
+        subcomponents = []
+        component_name = None
+        component_lines = None
+        for line in content_lines[1:-1]:
+            if component_name is None:
+                if line.startswith("BEGIN:"):
+                    component_name = line[6:].upper()
+                    component_lines = [] if component_name == "VEVENT" else [line + "\r\n"]
+                elif subcomponents or not PROPERTY_LINE_PATTERN.match(line):
+                    raise ValueError(f"Unexpected line in calendar: {line[:40]}")
+                else:
+                    header.append(line + "\r\n")
+                continue
+
+            if line.upper() == f"END:{component_name}":
+                if component_name == "VEVENT":
+                    subcomponents.append(cls._event_from_lines(component_lines))
+                else:
+                    component_lines.append(line + "\r\n")
+                    subcomponents.append(cls._raw_component_from_lines(component_name, component_lines))
+                component_name = None
+                continue
+
+            if component_name == "VEVENT":
+                if line.startswith("BEGIN:") or not PROPERTY_LINE_PATTERN.match(line):
+                    raise ValueError(f"Unexpected line in VEVENT: {line[:40]}")
+                component_lines.append(line)
+            else:
+                component_lines.append(line + "\r\n")
+
+        if component_name is not None:
+            raise ValueError(f"Component {component_name} is not closed")
+
+        return cls(("BEGIN:VCALENDAR\r\n" + "".join(header)).encode("utf-8"), subcomponents)
+
+    @staticmethod
+    def _raw_component_from_lines(name: str, lines: list[str]) -> RawComponent:
+        # icalendar builds timezones from VTIMEZONE components it does not know, we can't
+        if name == "VTIMEZONE":
+            for line in lines:
+                if line.upper().startswith("TZID") and TissCalendar.unfold(line).split(":", 1)[-1] not in pytz.all_timezones:
+                    raise ValueError("Unknown timezone in VTIMEZONE")
+        return RawComponent(name, "".join(lines))
+
+    @staticmethod
+    def _event_from_lines(lines: list[str]) -> TissEvent:
+        raw = {}
+        for line in lines:
+            name = re.split("[;:]", line, 1)[0].upper()
+            if name in raw:
+                raise ValueError(f"Property {name} occurs more than once")
+            raw[name] = line + "\r\n"
+
+        event = TissEvent(raw)
+        # these are read for every event anyway, decoding them here lets broken events fall back to icalendar
+        for name in ("SUMMARY", "DTSTART", "DTEND"):
+            if name in event:
+                event[name]
+        return event
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+
+from Metrics import CACHE_LOOKUPS, UPSTREAM_RESPONSES, timed
+from MyCalendar import MyCalendar
+from RequestProfiler import run_profiled
+
+
+class UpstreamEntry:
+    __slots__ = ("url", "content_hash", "etag", "last_modified", "fetched_at", "calendar")
+
+    def __init__(self, url: str, etag: str | None, last_modified: str | None, calendar: MyCalendar):
+        self.url = url
+        self.content_hash = calendar.content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+        self.calendar = calendar
+
+
+class UpstreamCache:
+    """Keeps the parsed TISS feeds per URL, so calendars that point to
+    the same feed share one copy and TISS is only asked (conditionally) once per max_age.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger = logging.getLogger(__name__),
+        max_age: int = 300,
+        max_entries: int = 1024,
+        connect_timeout: float = 5,
+        read_timeout: float = 5,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+    ):
+        self.logger = logger
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+
+        self._entries: OrderedDict[str, UpstreamEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._url_locks: dict[str, asyncio.Lock] = {}
+        self._url_lock_users: dict[str, int] = {}
+        self._client: httpx.AsyncClient | None = None
+
+    async def get_calendar(self, url: str, max_age: int | None = None) -> MyCalendar | None:
+        """Returns the parsed feed behind url. The returned calendar is shared between
+        all callers and must not be modified, use MyCalendar.copy() before changing it.
+
+        Arguments:
+            url {str} -- URL of the TISS feed
+
+        Keyword Arguments:
+            max_age {int | None} -- overrides the max_age of the cache for this call (default: {None})
+
+        Returns:
+            MyCalendar | None -- the parsed calendar, None if the feed could not be fetched
+        """
+        max_age = max_age if max_age is not None else self.max_age
+        entry = self._get_entry(url)
+        if entry is not None and time.monotonic() - entry.fetched_at < max_age:
+            CACHE_LOOKUPS.inc(cache="upstream", result="hit")
+            return entry.calendar
+
+        # concurrent requests for the same feed wait for a single download
+        async with self._url_lock(url):
+            fresh_entry = self._get_entry(url)
+            if fresh_entry is not None and time.monotonic() - fresh_entry.fetched_at < max_age:
+                CACHE_LOOKUPS.inc(cache="upstream", result="hit")
+                return fresh_entry.calendar
+
+            entry = await self._fetch(url, fresh_entry)
+            return entry.calendar if entry is not None else None
+
+    @asynccontextmanager
+    async def _url_lock(self, url: str):
+        """Lock per URL, it is removed again once nobody holds or waits for it (URLs come from users)"""
+        lock = self._url_locks.get(url)
+        if lock is None:
+            lock = self._url_locks[url] = asyncio.Lock()
+        self._url_lock_users[url] = self._url_lock_users.get(url, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._url_lock_users[url] -= 1
+            if self._url_lock_users[url] == 0:
+                del self._url_lock_users[url]
+                del self._url_locks[url]
+
+    async def _fetch(self, url: str, entry: UpstreamEntry | None) -> UpstreamEntry | None:
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        try:
+            with timed("upstream"):
+                req = await self._get_client().get(url, headers=headers)
+        except Exception as e:
+            UPSTREAM_RESPONSES.inc(status="error")
+            self.logger.info("Fetching upstream calendar failed: %s", e)
+            return None
+        UPSTREAM_RESPONSES.inc(status=str(req.status_code))
+
+        if req.status_code == 304 and entry is not None:
+            CACHE_LOOKUPS.inc(cache="upstream", result="not_modified")
+            self.logger.debug("Upstream calendar not modified (304): %s", url)
+            entry.fetched_at = time.monotonic()
+            return entry
+
+        if req.status_code != 200:
+            self.logger.info("Fetching upstream calendar failed with status %s", req.status_code)
+            return None
+
+        content_hash = hashlib.sha1(req.content).hexdigest()
+        if entry is not None and entry.content_hash == content_hash:
+            CACHE_LOOKUPS.inc(cache="upstream", result="unchanged")
+            self.logger.debug("Upstream calendar unchanged: %s", url)
+            calendar = entry.calendar
+        else:
+            CACHE_LOOKUPS.inc(cache="upstream", result="miss")
+            with timed("parse"):
+                calendar = await asyncio.to_thread(run_profiled, MyCalendar.from_ical, url, req.content)
+            if calendar is None:
+                return None
+
+        new_entry = UpstreamEntry(
+            url=url,
+            etag=req.headers.get("ETag"),
+            last_modified=req.headers.get("Last-Modified"),
+            calendar=calendar,
+        )
+        self._put_entry(new_entry)
+        return new_entry
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_entry(self, url: str) -> UpstreamEntry | None:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def _put_entry(self, entry: UpstreamEntry):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[entry.url] = entry
+            self._entries.move_to_end(entry.url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import logging
 import random
@@ -6,53 +7,84 @@ import string
 
 import redis
 from bson.objectid import ObjectId
+from pymongo.client_session import ClientSession
 
 from models.UserModels import UserDB
-from MyMongoClient import MyMongoClient
+from MyMongoClient import AsyncCollection
+from RequestProfiler import run_profiled
+
+# The redis DB is shared with the feed store, the scheduler lock and the profiler, sessions have their own keys:
+# SESSION_PREFIX + token -> uid and USER_SESSION_PREFIX + uid -> token
+SESSION_PREFIX = "tisscal:session:"
+USER_SESSION_PREFIX = "tisscal:user-session:"
+SESSION_TOKEN_LENGTH = 30
+SESSION_TOKEN_PATTERN = re.compile(rf"[A-Za-z0-9]{{{SESSION_TOKEN_LENGTH}}}")
+
+# Looks up the uid of a session token and extends the TTL of both session keys in one round trip
+VALIDATE_SESSION_SCRIPT = """
+local uid = redis.call("GET", KEYS[1])
+if not uid then
+    return false
+end
+if tonumber(ARGV[1]) > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+    redis.call("EXPIRE", ARGV[2] .. uid, ARGV[1])
+end
+return uid
+"""
+
+# Deletes the session of a user (both keys) in one round trip
+REVOKE_SESSION_SCRIPT = """
+local token = redis.call("GET", KEYS[1])
+if token then
+    redis.call("DEL", ARGV[1] .. token)
+end
+return redis.call("DEL", KEYS[1])
+"""
 
 
 class UserHandler:
     def __init__(
         self,
         logger: logging.Logger = logging.getLogger(__name__),
-        connection_string: str = "mongodb://localhost:27017",
-        db_name: str = "project",
-        user_collection: str = "users",
+        collection: AsyncCollection = None,
         redis_host: str = "localhost",
         redis_port: int = 6379,
         redis_password: str | None = None,
         redis_expire: int = 10800,
+        redis_max_connections: int = 50,
     ):
         self.logger = logger
 
-        self.connection_string = connection_string
-        self.db_name = db_name
-        self.user_collection = user_collection
+        self.collection = collection
         self.redis_host = redis_host
         self.redis_port = redis_port
         self.redis_password = redis_password
         self.redis_expire = redis_expire if redis_expire > 0 else None
+        self.redis_pool = redis.ConnectionPool(
+            host=self.redis_host,
+            port=self.redis_port,
+            password=self.redis_password,
+            max_connections=redis_max_connections,
+            decode_responses=True,
+        )
+        self._validate_session_script = redis.Redis(connection_pool=self.redis_pool).register_script(VALIDATE_SESSION_SCRIPT)
+        self._revoke_session_script = redis.Redis(connection_pool=self.redis_pool).register_script(REVOKE_SESSION_SCRIPT)
 
         self.logger.info("Initializing UserHandler")
-        self.logger.debug("    Mongo connection string: %s", self.connection_string)
-        self.logger.debug("    Mongo DB name:           %s", self.db_name)
-        self.logger.debug("    Mongo collection name:   %s", self.user_collection)
+        self.logger.debug("    Mongo collection name:   %s", self.collection.full_name)
         self.logger.debug("    Redis host:              %s", self.redis_host)
         self.logger.debug("    Redis port:              %s", self.redis_port)
         self.logger.debug("    Redis password:          %s", self.redis_password)
         self.logger.debug("    Redis expire:            %s", self.redis_expire)
-
-        with self._get_mongo_connection() as client:
-            if not client.check_connection():
-                self.logger.error("While initializing UserHandler: MongoDB connection failed")
-                raise Exception("MongoDB connection failed")
+        self.logger.debug("    Redis max connections:   %s", redis_max_connections)
 
         with self._get_redis_connection() as client:
             if not client.ping():
                 self.logger.error("While initializing UserHandler: MongoDB connection failed")
                 raise Exception("Redis connection failed")
 
-    def get_user_by_uid(self, uid: str) -> UserDB | None:
+    async def get_user_by_uid(self, uid: str) -> UserDB | None:
         """Retrieves a user from the database by its uid
 
         Arguments:
@@ -61,12 +93,11 @@ class UserHandler:
         Returns:
             UserDB | None -- UserDB object if the user was found, None otherwise
         """
-        with self._get_mongo_connection() as client:
-            data = client.find_one({"_id": ObjectId(uid)})
-            self.logger.debug("Getting user by uid: %s\nGot user: %s", uid, data)
-            return UserDB(**data) if data is not None else None
+        data = await self.collection.find_one({"_id": ObjectId(uid)})
+        self.logger.debug("Getting user by uid: %s\nGot user: %s", uid, data)
+        return UserDB(**data) if data is not None else None
 
-    def get_user_by_username(self, username: str) -> UserDB | None:
+    async def get_user_by_username(self, username: str) -> UserDB | None:
         """Retrieves a user from the database by its username
 
         Arguments:
@@ -75,12 +106,11 @@ class UserHandler:
         Returns:
             UserDB | None -- UserDB object if the user was found, None otherwise
         """
-        with self._get_mongo_connection() as client:
-            data = client.find_one({"usernameLower": username.lower()})
-            self.logger.debug("Getting user by username: %s\nGot user: %s", username, data)
-            return UserDB(**data) if data is not None else None
+        data = await self.collection.find_one({"usernameLower": username.lower()})
+        self.logger.debug("Getting user by username: %s\nGot user: %s", username, data)
+        return UserDB(**data) if data is not None else None
 
-    def login(self, username: str, password: str) -> str | None:
+    async def login(self, username: str, password: str) -> str | None:
         """Logs in a user and returns a session token
 
         Arguments:
@@ -91,7 +121,7 @@ class UserHandler:
             str | None -- session token if the login was successful, None otherwise
         """
         self.logger.info("Login: Logging in user %s", username)
-        user = self.get_user_by_username(username)
+        user = await self.get_user_by_username(username)
 
         if user is None:
             self.logger.info("Login failed: User not found: %s", username)
@@ -101,19 +131,17 @@ class UserHandler:
             self.logger.info("Login failed: Wrong password for user %s", username)
             return None
 
-        if (session := self.get_session(username=user.username)) is not None:
+        if (session := await self.get_session(username=user.username)) is not None:
             self.logger.info("Login: User %s already logged in, returning session token: %s", username, session[0])
             return session[0]
 
         session_token = self.generate_session_token()
-        with self._get_redis_connection() as client:
-            client.set(session_token, str(user.uid), ex=self.redis_expire)
-            client.set(str(user.uid), session_token, ex=self.redis_expire)
+        await self._run_redis(self._store_session, session_token, str(user.uid))
         self.logger.info("Login: User %s logged in, returning session token: %s", username, session_token)
 
         return session_token
 
-    def logout(self, uid: str) -> bool:
+    async def logout(self, uid: str) -> bool:
         """Logs out a user by its uid
 
         Arguments:
@@ -123,23 +151,31 @@ class UserHandler:
             bool -- returns True if the user was logged out, False otherwise
         """
         self.logger.info("Logout: Logging out user %s", uid)
-        if not self.check_login(uid=uid):
+        if not await self.revoke_session(uid):
             self.logger.info("Logout: User was never logged in or session already expired: %s", uid)
-            return True
+        return True
 
-        with self._get_redis_connection() as client:
-            token = client.get(uid)
-            client.delete(uid)
-            client.delete(token)
-            return True
+    async def revoke_session(self, uid: str) -> bool:
+        """Ends the session of a user (if there is one) with a single round trip to redis
+
+        Arguments:
+            uid {str} -- UID of the user
+
+        Returns:
+            bool -- True if a session existed, False otherwise
+        """
+        return await self._run_redis(self._revoke_session_script, keys=[USER_SESSION_PREFIX + uid], args=[SESSION_PREFIX]) == 1
 
     def logout_all(self):
         """Logs out all users"""
         with self._get_redis_connection() as client:
             self.logger.info("Logout all: Logging out all users")
-            client.flushdb()
+            # only the sessions, the DB also holds the feed store and the locks
+            for prefix in (SESSION_PREFIX, USER_SESSION_PREFIX):
+                for key in client.scan_iter(match=prefix + "*"):
+                    client.delete(key)
 
-    def check_login(self, token: str = None, uid: str = None, username: str = None) -> bool:
+    async def check_login(self, token: str = None, uid: str = None, username: str = None) -> bool:
         """Checks if a user is logged in / if a session in the database exists with the given token or uid.
         Only one of the arguments should be set. If multiple are set, the first one is used.
 
@@ -151,9 +187,31 @@ class UserHandler:
         Returns:
             bool -- Returns True if the user is logged in (a session exists), False otherwise
         """
-        return self.get_session(token, uid, username) is not None
+        return await self.get_session(token, uid, username) is not None
+
+    async def validate_session(self, token: str) -> str | None:
+        """Checks if a session with the given token exists and refreshes it. Other than calling
+        check_login, refresh_session and get_session this only needs a single round trip to redis.
+
+        Arguments:
+            token {str} -- token of the login session
+
+        Returns:
+            str | None -- uid of the logged in user if the session exists, None otherwise
+        """
+        # the cookie must not name any other key in redis (feeds, locks), only well-formed tokens are looked up
+        if not UserHandler.is_valid_session_token(token):
+            return None
+
+        uid = await self._run_redis(
+            self._validate_session_script,
+            keys=[SESSION_PREFIX + token],
+            args=[self.redis_expire or 0, USER_SESSION_PREFIX],
+        )
+        self.logger.debug("Validating session by token: %s, got uid: %s", token, uid)
+        return uid
 
-    def refresh_session(self, token: str = None, uid: str = None, username: str = None) -> tuple[str] | None:
+    async def refresh_session(self, token: str = None, uid: str = None, username: str = None) -> tuple[str] | None:
         """Refreshes the session of a user. If the user is not logged in, None is returned.
         Only one of the arguments should be set. If multiple are set, the first one is used.
 
@@ -165,32 +223,24 @@ class UserHandler:
         Returns:
             tuple[str] | None -- Returns a tuple of the session token and uid if the user is logged in, None otherwise
         """
-        with self._get_redis_connection() as client:
-            if token is not None:
-                self.logger.debug("Refreshing session by token: %s", token)
-                uid = client.get(token)
-
-            elif uid is not None:
-                self.logger.debug("Refreshing session by uid: %s", uid)
-                token = client.get(uid)
-
-            elif username is not None:
-                self.logger.debug("Refreshing session by username: %s", username)
-                user = self.get_user_by_username(username)
-                if user is not None:
-                    uid = str(user.uid)
-                    token = client.get(uid)
-
-            if uid is None or token is None:
-                self.logger.debug("Refreshing session: Session not found")
-                return None
+        if token is not None:
+            self.logger.debug("Refreshing session by token: %s", token)
+        elif uid is not None:
+            self.logger.debug("Refreshing session by uid: %s", uid)
+        elif username is not None:
+            self.logger.debug("Refreshing session by username: %s", username)
+            user = await self.get_user_by_username(username)
+            uid = str(user.uid) if user is not None else None
+
+        session = await self._run_redis(self._refresh_session, token, uid)
+        if session is None:
+            self.logger.debug("Refreshing session: Session not found")
+            return None
 
-            client.expire(uid, self.redis_expire)
-            client.expire(token, self.redis_expire)
-            self.logger.debug("Refreshing session: Session refreshed")
-            return token
+        self.logger.debug("Refreshing session: Session refreshed")
+        return session[0]
 
-    def get_session(self, token: str = None, uid: str = None, username: str = None) -> tuple[str] | None:
+    async def get_session(self, token: str = None, uid: str = None, username: str = None) -> tuple[str] | None:
         """Returns the session token and uid of a logged in user. If the user is not logged in, None is returned.
         Only one of the arguments should be set. If multiple are set, the first one is used.
 
@@ -202,35 +252,31 @@ class UserHandler:
         Returns:
             tuple[str] | None -- Returns a tuple of the session token and uid if the user is logged in, None otherwise
         """
-        with self._get_redis_connection() as client:
-            if token is not None:
-                self.logger.debug("Getting session by token: %s", token)
-                uid = client.get(token)
-
-            elif uid is not None:
-                self.logger.debug("Getting session by uid: %s", uid)
-                token = client.get(uid)
-
-            elif username is not None:
-                self.logger.debug("Getting session by username: %s", username)
-                user = self.get_user_by_username(username)
-                if user is not None:
-                    uid = str(user.uid)
-                    token = client.get(uid)
-
-            if token is None or uid is None:
-                self.logger.debug("Session not found")
-                return None
+        if token is not None:
+            self.logger.debug("Getting session by token: %s", token)
+        elif uid is not None:
+            self.logger.debug("Getting session by uid: %s", uid)
+        elif username is not None:
+            self.logger.debug("Getting session by username: %s", username)
+            user = await self.get_user_by_username(username)
+            uid = str(user.uid) if user is not None else None
+
+        session = await self._run_redis(self._get_session, token, uid)
+        if session is None:
+            self.logger.debug("Session not found")
+            return None
 
-            self.logger.debug("Session found (token, uid): %s, %s", token, uid)
-            return (token, uid)
+        self.logger.debug("Session found (token, uid): %s, %s", *session)
+        return session
 
     def get_all_sessions(self) -> list:
         """Returns a list of all sessions in the database"""
         with self._get_redis_connection() as client:
-            return [(key, client.get(key)) for key in client.keys()]
+            return [
+                (key[len(SESSION_PREFIX) :], client.get(key)) for key in client.scan_iter(match=SESSION_PREFIX + "*")
+            ]
 
-    def create_user(self, username: str, password: str) -> UserDB | None:
+    async def create_user(self, username: str, password: str) -> UserDB | None:
         """Creates a new user in the database and returns the user object
 
         Arguments:
@@ -251,61 +297,98 @@ class UserHandler:
             self.logger.info("Creating user failed: Password is too short (min 8 characters)")
             return None
 
-        if self.get_user_by_username(usernameLower) is not None:
+        if await self.get_user_by_username(usernameLower) is not None:
             self.logger.info("Creating user failed: User already exists (%s)", username)
             return None
 
-        with self._get_mongo_connection() as client:
-            result = client.insert_one(
-                {
-                    "username": username,
-                    "usernameLower": usernameLower,
-                    "password": hashlib.sha256(password.encode()).hexdigest(),
-                }
-            )
-
-            self.logger.debug("Created user: uid: %s", result.inserted_id)
-            return UserDB(
-                uid=result.inserted_id,
-                username=username,
-                usernameLower=usernameLower,
-                password=password,
-            )
-
-    def check_if_user_exists(self, username: str) -> bool:
-        return self.get_user_by_username(username) is not None
-
-    def delete_user_by_uid(self, uid: str):
-        """Deletes a user by its uid
+        result = await self.collection.insert_one(
+            {
+                "username": username,
+                "usernameLower": usernameLower,
+                "password": hashlib.sha256(password.encode()).hexdigest(),
+            }
+        )
+
+        self.logger.debug("Created user: uid: %s", result.inserted_id)
+        return UserDB(
+            uid=result.inserted_id,
+            username=username,
+            usernameLower=usernameLower,
+            password=password,
+        )
+
+    async def check_if_user_exists(self, username: str) -> bool:
+        return await self.get_user_by_username(username) is not None
+
+    async def delete_user_by_uid(self, uid: str, session: ClientSession = None) -> bool:
+        """Deletes a user by its uid. The session of the user is not touched, use revoke_session
+        (after the transaction, if there is one).
 
         Arguments:
             uid {str} -- UID of the user to delete
+
+        Keyword Arguments:
+            session {ClientSession} -- MongoDB session of the transaction to run in (default: {None})
+
+        Returns:
+            bool -- True if the user was deleted, False if it didn't exist
         """
         self.logger.info("Deleting user: uid: %s", uid)
-        if self.get_user_by_uid(uid) is None:
+        result = await self.collection.delete_one({"_id": ObjectId(uid)}, session=session)
+        if result.deleted_count == 0:
             self.logger.info("Deleting user: User already doesn't exists (uid: %s)", uid)
-            return
-
-        self.logger.info("Deleting user: Logging out user (uid: %s)", uid)
-        self.logout(uid=uid)
-        with self._get_mongo_connection as client:
-            client.delete_one({"_id": uid})
+            return False
+        return True
 
-    def generate_session_token(self, length=30) -> str:
+    def generate_session_token(self, length=SESSION_TOKEN_LENGTH) -> str:
         # characters = string.ascii_letters + string.digits + string.punctuation
         characters = string.ascii_letters + string.digits
         token = "".join(random.choice(characters) for i in range(length))
         return token
 
+    @staticmethod
+    def is_valid_session_token(token: str | None) -> bool:
+        return token is not None and SESSION_TOKEN_PATTERN.fullmatch(token) is not None
+
     @staticmethod
     def hash_password(password: str) -> str:
         return hashlib.sha256(password.encode()).hexdigest()
 
-    def _get_mongo_connection(self) -> MyMongoClient:
-        return MyMongoClient(self.connection_string, self.db_name, self.user_collection)
-
     def _get_redis_connection(self) -> redis.Redis:
-        return redis.Redis(host=self.redis_host, port=self.redis_port, password=self.redis_password, decode_responses=True)
+        return redis.Redis(connection_pool=self.redis_pool)
+
+    async def _run_redis(self, func, *args, **kwargs):
+        # redis-py is blocking, the round trip must not block the event loop
+        return await asyncio.to_thread(run_profiled, func, *args, **kwargs)
+
+    def _store_session(self, token: str, uid: str):
+        with self._get_redis_connection().pipeline() as pipe:
+            pipe.set(SESSION_PREFIX + token, uid, ex=self.redis_expire)
+            pipe.set(USER_SESSION_PREFIX + uid, token, ex=self.redis_expire)
+            pipe.execute()
+
+    def _get_session(self, token: str | None, uid: str | None) -> tuple[str, str] | None:
+        with self._get_redis_connection() as client:
+            if token is not None:
+                if not UserHandler.is_valid_session_token(token):
+                    return None
+                uid = client.get(SESSION_PREFIX + token)
+            elif uid is not None:
+                token = client.get(USER_SESSION_PREFIX + uid)
+
+            if token is None or uid is None:
+                return None
+            return (token, uid)
+
+    def _refresh_session(self, token: str | None, uid: str | None) -> tuple[str, str] | None:
+        with self._get_redis_connection() as client:
+            session = self._get_session(token, uid)
+            if session is None:
+                return None
+
+            client.expire(SESSION_PREFIX + session[0], self.redis_expire)
+            client.expire(USER_SESSION_PREFIX + session[1], self.redis_expire)
+            return session
 
     def __enter__(self):
         return self
@@ -314,5 +397,6 @@ class UserHandler:
         self.close()
 
     def close(self):
+        # sessions live in redis and are shared by all workers, closing one worker must not log out everybody
         self.logger.info("Closing UserHandler")
-        self.logout_all()
+        self.redis_pool.disconnect()
@@ -0,0 +1,193 @@
+import copy
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from bson.objectid import ObjectId
+
+
+def _matches(document: dict, query: dict) -> bool:
+    for key, value in query.items():
+        if isinstance(value, dict) and "$in" in value:
+            if document.get(key) not in value["$in"]:
+                return False
+        elif isinstance(value, dict) and "$exists" in value:
+            if (key in document) != value["$exists"]:
+                return False
+        elif document.get(key) != value:
+            return False
+    return True
+
+
+def _parent(document: dict, path: str) -> tuple[dict, str]:
+    # "events.<key>.will_remove" addresses document["events"]["<key>"]["will_remove"] like in MongoDB
+    *parents, field = path.split(".")
+    for parent in parents:
+        document = document.setdefault(parent, {})
+    return document, field
+
+
+class FakeCollection:
+    """In-memory stand-in for the parts of pymongo's Collection the handlers use"""
+
+    def __init__(self):
+        self.documents: list[dict] = []
+
+    def insert_one(self, document: dict):
+        document.setdefault("_id", ObjectId())
+        self.documents.append(copy.deepcopy(document))
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    def find_one(self, query: dict, projection: dict = None):
+        for document in self.documents:
+            if _matches(document, query):
+                return copy.deepcopy(document)
+        return None
+
+    def find(self, query: dict = None, projection: dict = None):
+        return [copy.deepcopy(document) for document in self.documents if _matches(document, query or {})]
+
+    def update_one(self, query: dict, update: dict):
+        for document in self.documents:
+            if not _matches(document, query):
+                continue
+
+            for path, value in update.get("$set", {}).items():
+                parent, field = _parent(document, path)
+                parent[field] = copy.deepcopy(value)
+            for path in update.get("$unset", {}):
+                parent, field = _parent(document, path)
+                parent.pop(field, None)
+            for key, value in update.get("$addToSet", {}).items():
+                values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for item in values:
+                    if item not in document.setdefault(key, []):
+                        document[key].append(copy.deepcopy(item))
+            return SimpleNamespace(matched_count=1, modified_count=1)
+        return SimpleNamespace(matched_count=0, modified_count=0)
+
+    def bulk_write(self, requests: list, ordered: bool = True):
+        # only UpdateOne requests, like the migrations write them
+        results = [self.update_one(request._filter, request._doc) for request in requests]
+        return SimpleNamespace(
+            matched_count=sum(result.matched_count for result in results),
+            modified_count=sum(result.modified_count for result in results),
+        )
+
+    def delete_one(self, query: dict):
+        for document in self.documents:
+            if _matches(document, query):
+                self.documents.remove(document)
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    def delete_many(self, query: dict):
+        count = len(self.documents)
+        self.documents = [document for document in self.documents if not _matches(document, query)]
+        return SimpleNamespace(deleted_count=count - len(self.documents))
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis commands used by the PrerenderedFeedStore (decoded responses)"""
+
+    def __init__(self):
+        self.data: dict[str, dict[str, str]] = {}
+
+    def hset(self, name: str, mapping: dict):
+        self.data.setdefault(name, {}).update({key: str(value) for key, value in mapping.items()})
+
+    def hgetall(self, name: str) -> dict[str, str]:
+        return dict(self.data.get(name, {}))
+
+    def expire(self, name: str, time: int):
+        return name in self.data
+
+    def delete(self, *names: str):
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        results = [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class UpstreamStandIn:
+    """Serves a feed on localhost like TISS does, including ETag based 304 responses.
+
+    Use as a context manager, the feed is available at .url
+    """
+
+    def __init__(self, content: bytes, conditional: bool = True):
+        self.content = content
+        self.conditional = conditional
+        self.requests = 0
+        self._server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def content(self) -> bytes:
+        return self._content
+
+    @content.setter
+    def content(self, content: bytes):
+        self._content = content
+        self.etag = f'"{hashlib.sha1(content).hexdigest()}"'
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/events/rest/calendar/personal?token=benchmark"
+
+    def __enter__(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stand_in.requests += 1
+                if stand_in.conditional and self.headers.get("If-None-Match") == stand_in.etag:
+                    self.send_response(304)
+                    self.send_header("ETag", stand_in.etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/calendar; charset=utf-8")
+                self.send_header("Content-Length", str(len(stand_in.content)))
+                self.send_header("ETag", stand_in.etag)
+                self.end_headers()
+                self.wfile.write(stand_in.content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,148 @@
+import csv
+import random
+from datetime import datetime, timedelta
+
+from icalendar.parser import escape_char, foldline
+
+from Lva import ROOMS_FILE, Lva
+from models.TissCalModels import TissCalDBCreate, calendar_to_document
+from TissCalHandler import TissCalHandler
+
+VTIMEZONE = """BEGIN:VTIMEZONE
+TZID:Europe/Vienna
+BEGIN:DAYLIGHT
+TZOFFSETFROM:+0100
+TZOFFSETTO:+0200
+TZNAME:CEST
+DTSTART:19700329T020000
+RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU
+END:DAYLIGHT
+BEGIN:STANDARD
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+TZNAME:CET
+DTSTART:19701025T030000
+RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU
+END:STANDARD
+END:VTIMEZONE"""
+
+COURSE_WORDS = [
+    "Algebra", "Analysis", "Diskrete", "Mathematik", "Informatik", "Programmierung", "Datenbanksysteme",
+    "Betriebssysteme", "Statistik", "Wahrscheinlichkeitstheorie", "Software", "Engineering", "Verteilte",
+    "Systeme", "Theoretische", "Logik", "Netzwerke", "Sicherheit", "Grundlagen", "Projekt", "Einführung",
+]
+PRIVATE_SUMMARIES = ["Sprechstunde", "Tutorium Vorbesprechung", "Lerngruppe", "Prüfungseinsicht"]
+
+
+def read_room_names(file=ROOMS_FILE) -> list[str]:
+    with open(file, "r", encoding="utf-8-sig") as csvfile:
+        return sorted({room[0] for room in csv.reader(csvfile, delimiter=";") if len(room) >= 9 and room[0]})
+
+
+def generate_feed(
+    events: int = 1000,
+    courses: int = 20,
+    room_mix: tuple[float, float, float] = (0.8, 0.15, 0.05),
+    category_mix: tuple[float, float, float] = (0.8, 0.1, 0.1),
+    private_ratio: float = 0.05,
+    seed: int = 1,
+) -> bytes:
+    """Generates an ICS feed that looks like the ones TISS produces
+
+    Keyword Arguments:
+        events {int} -- number of VEVENTs in the feed (default: {1000})
+        courses {int} -- number of distinct courses (LVAs) the events belong to (default: {20})
+        room_mix {tuple[float, float, float]} -- weights of events in a room listed in TU-Rooms.csv,
+            in a room that is not listed and without a location (default: {(0.8, 0.15, 0.05)})
+        category_mix {tuple[float, float, float]} -- weights of the categories COURSE, EXAM and GROUP (default: {(0.8, 0.1, 0.1)})
+        private_ratio {float} -- share of events that are not LVAs (default: {0.05})
+        seed {int} -- seed for the random generator, the same arguments always give the same feed (default: {1})
+
+    Returns:
+        bytes -- the feed, with CRLF line endings and folded lines
+    """
+    rng = random.Random(seed)
+    known_rooms = read_room_names()
+    lva_types = list(Lva.LVA_TYPE_MAP.keys())
+
+    course_summaries = []
+    for i in range(courses):
+        lva_id = f"{100 + i % 900:03d}.{rng.randint(0, 999):03d}"
+        lva_name = " ".join(rng.sample(COURSE_WORDS, rng.randint(2, 6)))
+        course_summaries.append(f"{lva_id} {rng.choice(lva_types)} {lva_name}")
+
+    lines = [
+        "BEGIN:VCALENDAR",
+        "PRODID:-//TU Wien//TISS Kalender//DE",
+        "VERSION:2.0",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:TISS Kalender",
+        *VTIMEZONE.splitlines(),
+    ]
+
+    start_of_semester = datetime(2023, 3, 1, 8, 0)
+    for i in range(events):
+        if rng.random() < private_ratio:
+            summary = rng.choice(PRIVATE_SUMMARIES)
+        else:
+            summary = course_summaries[rng.randrange(courses)]
+
+        start = start_of_semester + timedelta(days=rng.randrange(120), hours=rng.randrange(10), minutes=rng.choice((0, 15, 30, 45)))
+        end = start + timedelta(minutes=rng.choice((45, 90, 120, 180)))
+        category = rng.choices(("COURSE", "EXAM", "GROUP"), weights=category_mix)[0]
+        room = rng.choices(("known", "unknown", "none"), weights=room_mix)[0]
+        description = f"{summary}\n{rng.choice(COURSE_WORDS)}, {rng.choice(COURSE_WORDS)}; Termin {i}"
+
+        lines += [
+            "BEGIN:VEVENT",
+            "DTSTAMP:20230301T000000Z",
+            f"DTSTART;TZID=Europe/Vienna:{start:%Y%m%dT%H%M%S}",
+            f"DTEND;TZID=Europe/Vienna:{end:%Y%m%dT%H%M%S}",
+            f"SUMMARY:{escape_char(summary)}",
+        ]
+        if room == "known":
+            lines.append(f"LOCATION:{escape_char(rng.choice(known_rooms))}")
+        elif room == "unknown":
+            lines.append(f"LOCATION:Seminarraum {rng.randint(1, 400)}")
+        lines += [
+            f"CATEGORIES:{category}",
+            f"DESCRIPTION:{escape_char(description)}",
+            f"UID:{seed}-{i}@tiss.tuwien.ac.at",
+            "END:VEVENT",
+        ]
+
+    lines.append("END:VCALENDAR")
+    return "".join(foldline(line) + "\r\n" for line in lines).encode("utf-8")
+
+
+def generate_calendar_document(url: str, event_names: list[str], remove_ratio: float = 0.1) -> dict:
+    """Generates the MongoDB document of a calendar (as TissCalHandler stores it) with a configuration
+    for every event name, every 1/remove_ratio-th name (sorted) is configured to be removed
+
+    Arguments:
+        url {str} -- URL of the TISS feed of the calendar
+        event_names {list[str]} -- the distinct event names of the feed
+
+    Keyword Arguments:
+        remove_ratio {float} -- share of event names configured to be removed (default: {0.1})
+
+    Returns:
+        dict -- the document, without _id
+    """
+    remove_every = round(1 / remove_ratio) if remove_ratio > 0 else 0
+    data = TissCalDBCreate(
+        url=url,
+        name="Benchmark",
+        owner="benchmark",
+        token=TissCalHandler.generate_calendar_token(),
+        all_events=[
+            {
+                "name": name,
+                "will_prettify": Lva.is_lva_str(name),
+                "will_remove": remove_every > 0 and i % remove_every == remove_every - 1,
+                "is_lva": Lva.is_lva_str(name),
+            }
+            for i, name in enumerate(sorted(event_names))
+        ],
+    ).dict()
+    return calendar_to_document(data)
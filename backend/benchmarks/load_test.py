@@ -0,0 +1,66 @@
+"""Load test for a running backend: requests one URL (e.g. a formatted calendar) from many
+concurrent clients and reports the throughput and latencies. To see how the backend scales with
+the number of workers, run it against the same calendar with WEB_CONCURRENCY=1, 2, 4, ...
+
+    python -m benchmarks.load_test http://localhost:8111/api/cal/<token> --concurrency 64 --duration 30
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+
+import httpx
+
+
+async def run_client(client: httpx.AsyncClient, url: str, deadline: float, latencies: list[float], statuses: Counter):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.get(url)
+            await response.aread()
+            statuses[response.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_load_test(url: str, concurrency: int, duration: float, warmup: float) -> tuple[list[float], Counter, float]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        if warmup > 0:
+            await asyncio.gather(*(run_client(client, url, time.monotonic() + warmup, [], Counter()) for _ in range(concurrency)))
+
+        latencies, statuses = [], Counter()
+        start = time.monotonic()
+        await asyncio.gather(*(run_client(client, url, start + duration, latencies, statuses) for _ in range(concurrency)))
+        return latencies, statuses, time.monotonic() - start
+
+
+def percentile(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", help="URL to request, e.g. http://localhost:8111/api/cal/<token>")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of concurrent clients (default: 32)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to measure (default: 20)")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring (default: 3)")
+    args = parser.parse_args()
+
+    latencies, statuses, elapsed = asyncio.run(run_load_test(args.url, args.concurrency, args.duration, args.warmup))
+    if not latencies:
+        print("No successful requests:", dict(statuses))
+        return
+
+    print(f"{len(latencies)} requests in {elapsed:.1f}s with {args.concurrency} clients")
+    print(f"throughput:   {len(latencies) / elapsed:10.1f} requests/s")
+    for p in (50, 95, 99):
+        print(f"latency p{p}: {percentile(latencies, p) * 1000:10.1f} ms")
+    print("responses:   ", dict(statuses))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""Benchmarks of the render pipeline (parse, delete, prettify, UID, serialize and end to end) and of
+loading and returning a calendar with many configured events (/api/cal/data/{token}). For the two
+parsers (TissIcsParser and icalendar) the peak memory is measured as well.
+
+Runs offline: TISS is replaced by a local HTTP stand-in, Mongo and Redis by in-memory fakes.
+Run from the backend directory:
+
+    python -m benchmarks.run_benchmarks                 # print the results
+    python -m benchmarks.run_benchmarks --compare       # compare with benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --save          # store the results as new baseline
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from bson.objectid import ObjectId
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.testclient import TestClient
+from icalendar.cal import Calendar
+
+from benchmarks.Fakes import FakeCollection, FakeRedis, UpstreamStandIn
+from benchmarks.SyntheticFeed import generate_calendar_document, generate_feed
+from FeedCache import EventRenderCache, PrerenderedFeedStore
+from Lva import Lva, get_template
+from models.TissCalModels import TissCalDataResponse, TissCalDB, TissCalDBCreate, calendar_to_document
+from MyCalendar import MyCalendar
+from MyMongoClient import AsyncCollection
+from TissCalHandler import TissCalHandler
+from UpstreamCache import UpstreamCache
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+logger = logging.getLogger("benchmarks")
+
+
+def measure(func, setup=None, repeat: int = 5) -> list[float]:
+    """Calls func(setup()) repeat times and returns the durations in seconds, setup is not timed"""
+    durations = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def measure_peak_memory(func) -> float:
+    """Calls func once and returns the peak of the memory allocated meanwhile in KiB (traced by tracemalloc)"""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+async def measure_async(func, repeat: int = 5) -> list[float]:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def create_calendar_data(collection: FakeCollection, url: str, cal: MyCalendar, remove_ratio: float) -> TissCalDB:
+    document = generate_calendar_document(url, cal.get_distinct_events(), remove_ratio)
+    # insert_one adds the _id to the document
+    collection.insert_one(document)
+    return TissCalDB.from_document(document)
+
+
+def get_templates(cal_data: TissCalDB) -> dict[str, tuple[str, str, str]]:
+    template = cal_data.default_template
+    return {
+        event.name: (template.defaultLocationFormat, template.defaultDescriptionFormat, template.defaultSummaryFormat)
+        for event in cal_data.all_events
+        if event.is_lva and event.will_prettify
+    }
+
+
+def run_stages(feed: bytes, remove_ratio: float, repeat: int) -> dict[str, list[float]]:
+    results = {}
+    cal = MyCalendar.from_ical("benchmark", feed)
+    collection = FakeCollection()
+    cal_data = create_calendar_data(collection, "benchmark", cal, remove_ratio)
+    handler = TissCalHandler(logger=logger, collection=AsyncCollection(collection))
+    remove_names = {event.name for event in cal_data.all_events if event.will_remove}
+    templates = get_templates(cal_data)
+
+    def prettify(c: MyCalendar):
+        for name, event_templates in templates.items():
+            course_properties = Lva.course_properties_from_summary(name)
+            for event in c.get_events_by_name(name):
+                MyCalendar._prettify_event(event, *event_templates, course_properties)
+
+    def uncached_templates_copy() -> MyCalendar:
+        # every run compiles the templates again, like before they were cached
+        get_template.cache_clear()
+        return cal.copy()
+
+    def rendered_copy() -> MyCalendar:
+        c = cal.copy()
+        c.prettify(remove_names, templates)
+        return c
+
+    # compiles the templates and loads the rooms, so the first timed run does not pay for it
+    b"".join(handler.render_calendar(cal_data, cal.copy()))
+
+    results["parse"] = measure(lambda _: MyCalendar.from_ical("benchmark", feed), repeat=repeat)
+    results["parse_icalendar"] = measure(lambda _: Calendar.from_ical(feed), repeat=repeat)
+    results["delete"] = measure(lambda c: c.delete_events_by_names(remove_names), cal.copy, repeat)
+    results["prettify"] = measure(prettify, cal.copy, repeat)
+    results["prettify_uncached_templates"] = measure(prettify, uncached_templates_copy, repeat)
+    results["uid"] = measure(lambda c: c.update_event_uids(), cal.copy, repeat)
+    results["serialize"] = measure(lambda c: b"".join(c.iter_ical()), rendered_copy, repeat)
+    results["render"] = measure(lambda c: b"".join(handler.render_calendar(cal_data, c)), cal.copy, repeat)
+
+    # same as render, but every event is already in the cache (a refresh where nothing changed)
+    handler.event_cache = EventRenderCache()
+    b"".join(handler.render_calendar(cal_data, cal.copy()))
+    results["render_event_cache"] = measure(lambda c: b"".join(handler.render_calendar(cal_data, c)), cal.copy, repeat)
+    return results
+
+
+def run_parse_memory(feed: bytes) -> dict[str, float]:
+    # the parsed calendar is returned, so the peak includes the result and not only temporary objects
+    return {
+        "parse": measure_peak_memory(lambda: MyCalendar.from_ical("benchmark", feed)),
+        "parse_icalendar": measure_peak_memory(lambda: Calendar.from_ical(feed)),
+    }
+
+
+async def run_end_to_end(feed: bytes, remove_ratio: float, repeat: int) -> dict[str, list[float]]:
+    results = {}
+    with UpstreamStandIn(feed) as upstream:
+        collection = FakeCollection()
+        cal_data = create_calendar_data(collection, upstream.url, MyCalendar.from_ical(upstream.url, feed), remove_ratio)
+
+        # TISS answers with the full feed, which is parsed and rendered
+        async def get_feed_cold():
+            handler = TissCalHandler(
+                logger=logger, collection=AsyncCollection(collection), upstream_cache=UpstreamCache(logger=logger, max_age=0)
+            )
+            assert await handler.get_feed(cal_data.token) is not None
+            await handler.upstream_cache.close()
+
+        results["end_to_end"] = await measure_async(get_feed_cold, repeat)
+
+        # TISS answers 304 Not Modified, the parsed feed is reused and rendered again
+        handler = TissCalHandler(
+            logger=logger, collection=AsyncCollection(collection), upstream_cache=UpstreamCache(logger=logger, max_age=0)
+        )
+        await handler.get_feed(cal_data.token)
+        results["end_to_end_not_modified"] = await measure_async(lambda: handler.get_feed(cal_data.token), repeat)
+
+        # the feed was rendered by the refresh scheduler and is served from redis
+        handler.feed_store = PrerenderedFeedStore(redis_pool=None, redis_client=FakeRedis())
+        await handler.get_feed(cal_data.token)
+        results["end_to_end_prerendered"] = await measure_async(lambda: handler.get_feed(cal_data.token), repeat)
+        await handler.upstream_cache.close()
+    return results
+
+
+def create_calendar_document(event_configs: int) -> dict:
+    data = TissCalDBCreate(
+        url="benchmark",
+        name="Benchmark",
+        owner="benchmark",
+        token=TissCalHandler.generate_calendar_token(),
+        all_events=[
+            {
+                "name": f"{100 + i // 1000}.{i % 1000:03d} VO Course number {i}",
+                "will_prettify": True,
+                "is_lva": True,
+                "summaryFormat": "{{LvaTypeShort}} {{LvaName}}" if i % 2 else None,
+            }
+            for i in range(event_configs)
+        ],
+    ).dict()
+    document = calendar_to_document(data)
+    document["_id"] = ObjectId()
+    return document
+
+
+def run_calendar_document(event_configs: int, repeat: int) -> dict[str, list[float]]:
+    results = {}
+    document = create_calendar_document(event_configs)
+    app = FastAPI()
+
+    # as /api/cal/data/{token} did before: validated load, copied into the response model, json
+    @app.get("/validated", response_model=TissCalDataResponse, response_class=JSONResponse)
+    async def get_validated():
+        return TissCalDataResponse(**TissCalDB.from_document(document, validate=True).dict())
+
+    # trusted load, the response_model picks the fields, orjson
+    @app.get("/trusted", response_model=TissCalDataResponse, response_class=ORJSONResponse)
+    async def get_trusted():
+        return TissCalDB.from_document(document)
+
+    results["load_document"] = measure(lambda _: TissCalDB.from_document(document), repeat=repeat)
+    results["load_document_validated"] = measure(lambda _: TissCalDB.from_document(document, validate=True), repeat=repeat)
+    with TestClient(app) as client:
+        assert client.get("/trusted").json()["all_events"] == client.get("/validated").json()["all_events"]
+        results["data_response"] = measure(lambda _: client.get("/trusted"), repeat=repeat)
+        results["data_response_validated"] = measure(lambda _: client.get("/validated"), repeat=repeat)
+    return results
+
+
+def summarize(durations: list[float]) -> dict[str, float]:
+    return {
+        "min_ms": round(min(durations) * 1000, 3),
+        "median_ms": round(statistics.median(durations) * 1000, 3),
+    }
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], tolerance: float, unit: str = "ms") -> list[str]:
+    regressions = []
+    print(f"\n{'stage':<30}{'baseline ' + unit:>14}{'current ' + unit:>14}{'change':>10}")
+    for stage, current in results.items():
+        if stage not in baseline:
+            print(f"{stage:<30}{'-':>14}{current:>14.3f}{'new':>10}")
+            continue
+
+        old = baseline[stage]
+        change = current / old - 1 if old else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(stage)
+            flag = "  <- regression"
+        print(f"{stage:<30}{old:>14.3f}{current:>14.3f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000, help="number of events in the synthetic feed")
+    parser.add_argument("--courses", type=int, default=40, help="number of distinct courses in the synthetic feed")
+    parser.add_argument(
+        "--room-mix", type=float, nargs=3, default=(0.8, 0.15, 0.05), metavar=("KNOWN", "UNKNOWN", "NONE"),
+        help="weights of events in a known room, an unknown room and without location",
+    )
+    parser.add_argument(
+        "--category-mix", type=float, nargs=3, default=(0.8, 0.1, 0.1), metavar=("COURSE", "EXAM", "GROUP"),
+        help="weights of the event categories",
+    )
+    parser.add_argument("--private-ratio", type=float, default=0.05, help="share of events that are not LVAs")
+    parser.add_argument("--remove-ratio", type=float, default=0.1, help="share of event names configured to be removed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--event-configs", type=int, default=5000, help="number of configured events of the calendar for the data_response stages"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the median is compared")
+    parser.add_argument("--save", action="store_true", help=f"store the results in {BASELINE_FILE}")
+    parser.add_argument("--compare", action="store_true", help="compare with the baseline, exit code 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown of the median (default: 0.25)")
+    args = parser.parse_args()
+
+    parameters = {
+        "events": args.events,
+        "courses": args.courses,
+        "room_mix": list(args.room_mix),
+        "category_mix": list(args.category_mix),
+        "private_ratio": args.private_ratio,
+        "remove_ratio": args.remove_ratio,
+        "seed": args.seed,
+        "event_configs": args.event_configs,
+    }
+    feed = generate_feed(
+        events=args.events,
+        courses=args.courses,
+        room_mix=tuple(args.room_mix),
+        category_mix=tuple(args.category_mix),
+        private_ratio=args.private_ratio,
+        seed=args.seed,
+    )
+    print(f"Synthetic feed: {args.events} events, {args.courses} courses, {len(feed) / 1024:.0f} KiB")
+
+    durations = run_stages(feed, args.remove_ratio, args.repeat)
+    durations.update(asyncio.run(run_end_to_end(feed, args.remove_ratio, args.repeat)))
+    durations.update(run_calendar_document(args.event_configs, args.repeat))
+    results = {stage: summarize(values) for stage, values in durations.items()}
+    peak_memory = run_parse_memory(feed)
+
+    print(f"\n{'stage':<30}{'min ms':>14}{'median ms':>14}")
+    for stage, summary in results.items():
+        print(f"{stage:<30}{summary['min_ms']:>14.3f}{summary['median_ms']:>14.3f}")
+
+    print(f"\n{'stage':<30}{'peak KiB':>14}")
+    for stage, peak in peak_memory.items():
+        print(f"{stage:<30}{peak:>14.1f}")
+
+    exit_code = 0
+    if args.compare:
+        with open(BASELINE_FILE, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline["parameters"] != parameters:
+            print("\nThe baseline was recorded with different parameters, not comparing:", baseline["parameters"])
+            exit_code = 2
+        else:
+            regressions = compare(
+                {stage: summary["median_ms"] for stage, summary in results.items()},
+                {stage: summary["median_ms"] for stage, summary in baseline["results"].items()},
+                args.tolerance,
+            )
+            # peak memory of the parsers, baselines from before it was measured have none
+            regressions += [
+                f"{stage} (memory)"
+                for stage in compare(peak_memory, baseline.get("peak_memory_kib", {}), args.tolerance, unit="KiB")
+            ]
+            if regressions:
+                print(f"\n{len(regressions)} stage(s) are more than {args.tolerance:.0%} slower than the baseline")
+                exit_code = 1
+
+    if args.save:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "parameters": parameters,
+                    "python": platform.python_version(),
+                    "results": results,
+                    "peak_memory_kib": peak_memory,
+                },
+                file,
+                indent=4,
+            )
+            file.write("\n")
+        print(f"\nBaseline saved to {BASELINE_FILE}")
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
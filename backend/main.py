@@ -1,23 +1,23 @@
 import logging
 import os
-from io import StringIO
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, Request, Response, Security
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, Security
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security.api_key import APIKeyCookie
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.routing import Match
 
+from FeedCache import EventRenderCache, FeedCache, PrerenderedFeedStore
+from Metrics import CACHE_ENTRIES, CACHE_LOOKUPS, FEED_REQUESTS, REGISTRY, ServerTiming, timed
 from models.ErrorResponse import ErrorResponse
 from models.TissCalModels import (
     TissCalCreateRequest,
     TissCalCreateResponse,
-    TissCalDB,
     TissCalDataResponse,
     TissCalListResponse,
-    TissCalResponse,
     TissCalSuccessDeleteResponse,
     TissCalChangeRequest,
     TissCalChangeResponse,
@@ -25,8 +25,13 @@ from models.TissCalModels import (
 )
 from models.UserModels import UserCreateRequest, UserCreateResponse, UserDB, UserDeleteResponse, UserLoginRequest, UserLoginResponse, UserLogoutResponse, UserResponse
 from MyCalendar import MyCalendar
+from Migrations import run_migrations
 from MyHTTPException import MyHTTPException
+from MyMongoClient import MyMongoClient
+from RefreshScheduler import RefreshScheduler
+from RequestProfiler import RequestProfiler
 from TissCalHandler import TissCalHandler
+from UpstreamCache import UpstreamCache
 from UserHandler import UserHandler
 
 # Setup Logging ####
@@ -47,7 +52,27 @@ MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING")
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
 DEVELOPMENT_MODE = os.getenv("DEVELOPMENT_MODE")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 20000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+FEED_CACHE_TTL = int(os.getenv("FEED_CACHE_TTL", 3600))
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", 512))
+EVENT_CACHE_SIZE = int(os.getenv("EVENT_CACHE_SIZE", 10000))
+UPSTREAM_MAX_AGE = int(os.getenv("UPSTREAM_MAX_AGE", 300))
+UPSTREAM_CACHE_SIZE = int(os.getenv("UPSTREAM_CACHE_SIZE", 1024))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 5))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 20))
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", 1)), 1)
+REFRESH_SCHEDULER = os.getenv("REFRESH_SCHEDULER")
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", 900))
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", 4))
+PROFILING_SECRET = os.getenv("PROFILING_SECRET")
+PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+PROFILING_MIN_INTERVAL = int(os.getenv("PROFILING_MIN_INTERVAL", 60))
 
 if BASE_URL is None:
     logger.error("BASE_URL environment variable is not set")
@@ -61,13 +86,29 @@ if REDIS_HOST is None:
 if REDIS_PASSWORD in (None, "", "None"):
     REDIS_PASSWORD = None
 
+if REFRESH_SCHEDULER in ("False", "false", "0"):
+    REFRESH_SCHEDULER = False
+else:
+    REFRESH_SCHEDULER = True
+
+if PROFILING_SECRET in ("", "None"):
+    PROFILING_SECRET = None
+
 if DEVELOPMENT_MODE in (None, "", "None", "False", "false"):
     DEVELOPMENT_MODE = False
 else:
     DEVELOPMENT_MODE = True
 
 
-app = FastAPI(root_path=BASE_URL, title="TissCal API")
+# The in-memory caches exist once per worker process, their sizes are shared out among the workers
+# so the memory of the whole instance stays the same with more workers
+FEED_CACHE_WORKER_SIZE = max(FEED_CACHE_SIZE // WEB_CONCURRENCY, 1) if FEED_CACHE_SIZE > 0 else 0
+EVENT_CACHE_WORKER_SIZE = max(EVENT_CACHE_SIZE // WEB_CONCURRENCY, 1) if EVENT_CACHE_SIZE > 0 else 0
+UPSTREAM_CACHE_WORKER_SIZE = max(UPSTREAM_CACHE_SIZE // WEB_CONCURRENCY, 1) if UPSTREAM_CACHE_SIZE > 0 else 0
+
+
+# orjson serializes the responses (e.g. calendars with many events) a lot faster than json
+app = FastAPI(root_path=BASE_URL, title="TissCal API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -77,21 +118,68 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+mongo_client = MyMongoClient(
+    MONGO_CONNECTION_STRING,
+    "tisscal",
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+)
+if not mongo_client.check_connection():
+    logger.error("MongoDB connection failed")
+    exit(1)
+
+try:
+    run_migrations(mongo_client.db, logger=logger)
+except Exception as e:
+    logger.error("MongoDB migration failed: %s", e)
+    exit(1)
+
 user_handler = UserHandler(
     logger=logger,
-    connection_string=MONGO_CONNECTION_STRING,
-    db_name="tisscal",
-    user_collection="users",
+    collection=mongo_client.get_async_collection("users"),
     redis_host=REDIS_HOST,
     redis_port=REDIS_PORT,
     redis_password=REDIS_PASSWORD,
+    redis_max_connections=REDIS_MAX_CONNECTIONS,
 )
 tiss_cal_handler = TissCalHandler(
     logger=logger,
-    connection_string=MONGO_CONNECTION_STRING,
-    db_name="tisscal",
-    tiss_cal_collection="calendars",
+    collection=mongo_client.get_async_collection("calendars"),
     user_handler=user_handler,
+    feed_cache=FeedCache(ttl=FEED_CACHE_TTL, max_entries=FEED_CACHE_WORKER_SIZE),
+    upstream_cache=UpstreamCache(
+        logger=logger,
+        max_age=UPSTREAM_MAX_AGE,
+        max_entries=UPSTREAM_CACHE_WORKER_SIZE,
+        connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+        read_timeout=UPSTREAM_READ_TIMEOUT,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+    ),
+    feed_store=PrerenderedFeedStore(user_handler.redis_pool, ttl=REFRESH_INTERVAL * 2) if REFRESH_SCHEDULER else None,
+    event_cache=EventRenderCache(max_entries=EVENT_CACHE_WORKER_SIZE),
+)
+CACHE_ENTRIES.set_function(lambda: len(tiss_cal_handler.feed_cache), cache="feed")
+CACHE_ENTRIES.set_function(lambda: len(tiss_cal_handler.event_cache), cache="event")
+CACHE_ENTRIES.set_function(lambda: len(tiss_cal_handler.upstream_cache), cache="upstream")
+CACHE_LOOKUPS.set_function(lambda: tiss_cal_handler.event_cache.hits, cache="event", result="hit")
+CACHE_LOOKUPS.set_function(lambda: tiss_cal_handler.event_cache.misses, cache="event", result="miss")
+
+refresh_scheduler = RefreshScheduler(
+    logger=logger,
+    tiss_cal_handler=tiss_cal_handler,
+    redis_pool=user_handler.redis_pool,
+    interval=REFRESH_INTERVAL,
+    concurrency=REFRESH_CONCURRENCY,
+)
+
+request_profiler = RequestProfiler(
+    logger=logger,
+    redis_pool=user_handler.redis_pool,
+    secret=PROFILING_SECRET,
+    output_dir=PROFILING_DIR,
+    min_interval=PROFILING_MIN_INTERVAL,
 )
 
 api_key_cookie = APIKeyCookie(name="token", auto_error=False)
@@ -102,34 +190,85 @@ templates = Jinja2Templates(directory="../frontend/dist")
 # Exception handlers ####
 @app.exception_handler(MyHTTPException)
 def my_http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content=ErrorResponse(message=exc.detail).dict())
+    return ORJSONResponse(status_code=exc.status_code, content=ErrorResponse(message=exc.detail).dict())
+
+
+# Profiling ####
+if request_profiler.enabled:
+
+    def get_calendar_token(request: Request) -> str | None:
+        # routing happens after the middleware, the route is matched here the same way to get its token
+        for route in app.router.routes:
+            match, child_scope = route.matches(request.scope)
+            if match == Match.FULL:
+                if not route.path.startswith("/api/cal/"):
+                    return None
+                return child_scope.get("path_params", {}).get("token")
+        return None
+
+    @app.middleware("http")
+    async def profile_calendar_requests(request: Request, call_next):
+        # only /api/cal/... requests of a calendar (with a token in the path) carrying the PROFILING_SECRET are profiled
+        token = get_calendar_token(request)
+        if token is None or not request_profiler.is_requested(request.headers):
+            return await call_next(request)
+
+        with request_profiler.profile(token) as profile_path:
+            response = await call_next(request)
+        if profile_path is not None:
+            response.headers["X-Profile-File"] = os.path.basename(profile_path)
+        return response
 
 
 # Authentication ####
-def verify_token(token: str = Security(api_key_cookie)) -> UserDB | None:
-    if not user_handler.check_login(token=token):
+async def verify_token(token: str = Security(api_key_cookie)) -> UserDB | None:
+    if (uid := await user_handler.validate_session(token)) is None:
         raise MyHTTPException(status_code=401, detail="Request not authenticated")
-    user_handler.refresh_session(token=token)
-    uid = user_handler.get_session(token=token)[1]
-    return user_handler.get_user_by_uid(uid)
+    return await user_handler.get_user_by_uid(uid)
 
 
 # Events ####
 @app.on_event("startup")
 async def startup_event():
-    logger.warning("Starting up")
+    logger.warning("Starting up (worker %s of %s)", os.getpid(), WEB_CONCURRENCY)
     logger.debug("Environment variables:")
     logger.debug(f"BASE_URL:                {BASE_URL}")
     logger.debug(f"MONGO_CONNECTION_STRING: {MONGO_CONNECTION_STRING}")
     logger.debug(f"REDIS_HOST:              {REDIS_HOST}")
     logger.debug(f"REDIS_PORT:              {REDIS_PORT}")
     logger.debug(f"REDIS_PASSWORD:          {REDIS_PASSWORD}")
+    logger.debug(f"REDIS_MAX_CONNECTIONS:   {REDIS_MAX_CONNECTIONS}")
     logger.debug(f"DEVELOPMENT_MODE:        {DEVELOPMENT_MODE}")
+    logger.debug(f"MONGO_MAX_POOL_SIZE:     {MONGO_MAX_POOL_SIZE}")
+    logger.debug(f"MONGO_MIN_POOL_SIZE:     {MONGO_MIN_POOL_SIZE}")
+    logger.debug(f"MONGO_CONNECT_TIMEOUT_MS:{MONGO_CONNECT_TIMEOUT_MS}")
+    logger.debug(f"MONGO_SERVER_SELECTION_TIMEOUT_MS: {MONGO_SERVER_SELECTION_TIMEOUT_MS}")
+    logger.debug(f"FEED_CACHE_TTL:          {FEED_CACHE_TTL}")
+    logger.debug(f"FEED_CACHE_SIZE:         {FEED_CACHE_SIZE}")
+    logger.debug(f"EVENT_CACHE_SIZE:        {EVENT_CACHE_SIZE}")
+    logger.debug(f"UPSTREAM_MAX_AGE:        {UPSTREAM_MAX_AGE}")
+    logger.debug(f"UPSTREAM_CACHE_SIZE:     {UPSTREAM_CACHE_SIZE}")
+    logger.debug(f"UPSTREAM_CONNECT_TIMEOUT:{UPSTREAM_CONNECT_TIMEOUT}")
+    logger.debug(f"UPSTREAM_READ_TIMEOUT:   {UPSTREAM_READ_TIMEOUT}")
+    logger.debug(f"UPSTREAM_MAX_CONNECTIONS:{UPSTREAM_MAX_CONNECTIONS}")
+    logger.debug(f"WEB_CONCURRENCY:         {WEB_CONCURRENCY}")
+    logger.debug(f"REFRESH_SCHEDULER:       {REFRESH_SCHEDULER}")
+    logger.debug(f"REFRESH_INTERVAL:        {REFRESH_INTERVAL}")
+    logger.debug(f"REFRESH_CONCURRENCY:     {REFRESH_CONCURRENCY}")
+    logger.debug(f"PROFILING_SECRET:        {'set' if PROFILING_SECRET else None}")
+    logger.debug(f"PROFILING_DIR:           {PROFILING_DIR}")
+    logger.debug(f"PROFILING_MIN_INTERVAL:  {PROFILING_MIN_INTERVAL}")
+
+    if REFRESH_SCHEDULER:
+        refresh_scheduler.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await refresh_scheduler.stop()
     user_handler.close()
+    await tiss_cal_handler.upstream_cache.close()
+    mongo_client.close()
     logger.warning("Shuted down")
 
 
@@ -141,7 +280,7 @@ async def user_data_me(current_user: UserDB = Depends(verify_token)):
 
 @app.post("/api/login", response_model=UserLoginResponse)
 async def login(request: UserLoginRequest, response: Response):
-    if not (token := user_handler.login(request.username, request.password)):
+    if not (token := await user_handler.login(request.username, request.password)):
         raise MyHTTPException(status_code=404, detail="User name or password incorrect")
 
     response.set_cookie(key="token", value=token, max_age=60 * 60, httponly=True, samesite="none", secure=True)
@@ -152,60 +291,74 @@ async def login(request: UserLoginRequest, response: Response):
 
 @app.get("/api/logout", response_model=UserLogoutResponse, status_code=200)
 async def logout(response: Response, current_user: UserDB = Depends(verify_token)):
-    user_handler.logout(str(current_user.uid))
+    await user_handler.logout(str(current_user.uid))
     response.delete_cookie(key="token")
     return {}
 
 
 @app.post("/api/user/create", response_model=UserCreateResponse, status_code=200)
 async def create_user(request: UserCreateRequest, response: Response):
-    if user_handler.check_if_user_exists(request.username):
+    if await user_handler.check_if_user_exists(request.username):
         raise MyHTTPException(status_code=400, detail="User already exists")
-    if not user_handler.create_user(request.username, request.password):
+    if not await user_handler.create_user(request.username, request.password):
         raise MyHTTPException(status_code=400, detail="Can't create user :I")
-    token = user_handler.login(request.username, request.password)
+    token = await user_handler.login(request.username, request.password)
     response.set_cookie(key="token", value=token, max_age=60 * 60, httponly=True, samesite="none", secure=True)
     return UserCreateResponse(username=request.username)
 
 
 @app.get("/api/user/delete", response_model=UserDeleteResponse, status_code=200)
 async def delete_user(current_user: UserDB = Depends(verify_token)):
-    cals = tiss_cal_handler.get_calendars_by_owner(str(current_user.uid))
-    for cal in cals:
-        tiss_cal_handler.delete_calendar_by_id(cal.id)
-    user_handler.delete_user_by_uid(str(current_user.uid))
+    uid = str(current_user.uid)
+
+    async def delete_user_and_calendars(session):
+        deleted_calendars = await tiss_cal_handler.delete_calendars_by_owner(uid, session=session)
+        await user_handler.delete_user_by_uid(uid, session=session)
+        return deleted_calendars
+
+    # all or nothing where MongoDB supports transactions, the session is revoked once the data is gone
+    deleted_calendars = await mongo_client.run_in_transaction(delete_user_and_calendars)
+    await user_handler.revoke_session(uid)
+    logger.info("Deleted user %s and %s calendars", uid, deleted_calendars)
     return UserDeleteResponse()
 
 
 @app.post("/api/cal/create", response_model=TissCalCreateResponse, status_code=200)
 async def create_cal(request: TissCalCreateRequest, current_user: UserDB = Depends(verify_token)):
-    cal = tiss_cal_handler.create_new_calendar(url=request.url, name=request.name, owner=str(current_user.uid))
+    cal = await tiss_cal_handler.create_new_calendar(url=request.url, name=request.name, owner=str(current_user.uid))
     if cal is None:
         raise MyHTTPException(status_code=400, detail="Can't create calendar :I")
-    return TissCalCreateResponse(**cal.dict())
+    # the response_model picks the fields of the response, no copy into TissCalCreateResponse needed
+    return cal
 
 
 @app.get("/api/cal/list", response_model=TissCalListResponse, status_code=200)
-async def get_calendars(current_user: UserDB = Depends(verify_token)):
-    cals = tiss_cal_handler.get_calendars_by_owner(str(current_user.uid))
-    if cals is None:
-        raise MyHTTPException(status_code=404, detail="No calendars found / Something went wrong :I")
-    return TissCalListResponse(calendars=[TissCalResponse(**cal.dict()) for cal in cals])
+async def get_calendars(
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str | None = None,
+    current_user: UserDB = Depends(verify_token),
+):
+    # only name, url and token, the event configuration is loaded by /api/cal/data/{token}
+    res = await tiss_cal_handler.get_calendar_summaries_by_owner(str(current_user.uid), limit=limit, cursor=cursor)
+    if res is None:
+        raise MyHTTPException(status_code=400, detail="Invalid cursor :I")
+    cals, next_cursor = res
+    return TissCalListResponse(calendars=cals, next_cursor=next_cursor)
 
 
 @app.get("/api/cal/delete/{token}", response_model=TissCalSuccessDeleteResponse, status_code=200)
 async def delete_calender(token: str, current_user: UserDB = Depends(verify_token)):
     # TODO: Check if user is owner
-    res = tiss_cal_handler.delete_calendar_by_token(token)
+    res = await tiss_cal_handler.delete_calendar_by_token(token)
     return {}
 
 
 @app.get("/api/cal/data/{token}", response_model=TissCalDataResponse, status_code=200)
 async def get_calendar_data(token: str, current_user: UserDB = Depends(verify_token)):
-    res = tiss_cal_handler.get_calendar_by_token(token)
+    res = await tiss_cal_handler.get_calendar_by_token(token)
     if res is None:
         raise MyHTTPException(status_code=404, detail="There is no calendar with this token :I")
-    return TissCalDataResponse(**res.dict())
+    return res
 
 
 @app.post("/api/cal/data", response_model=TissCalChangeResponse, status_code=200)
@@ -213,26 +366,35 @@ async def update_calender_data(request: TissCalChangeRequest, current_user: User
     # TODO: Check if user is owner
     # TODO: Handle token change (or deny it at all) -> for now token changes are just ignored (not changed at all)
     # TODO: Check if given templates are valid (contain only valid placeholders)
-    old_cal = tiss_cal_handler.get_calendar_by_token(request.token)
+    old_cal = await tiss_cal_handler.get_calendar_by_token(request.token)
     if old_cal is None:
         raise MyHTTPException(status_code=404, detail="There is no calendar with this token :I")
-    res = tiss_cal_handler.update_calendar(TissCalDB(**{**old_cal.dict(), **request.dict(exclude={"token"})}))
-    return TissCalChangeResponse(**res.dict())
+    # the request is validated already, its fields replace the ones of the stored calendar as they are
+    changes = {field: getattr(request, field) for field in request.__fields__ if field != "token"}
+    return await tiss_cal_handler.update_calendar(old_cal.copy(update=changes))
 
 
 @app.get("/api/cal/{token}", status_code=200)
-async def get_calender_by_token(token: str, response: Response):
-    cal = tiss_cal_handler.prettify_calendar(token)
-    if cal is None:
+async def get_calender_by_token(token: str, request: Request):
+    with ServerTiming() as server_timing, timed("total"):
+        feed = await tiss_cal_handler.get_feed(token)
+    if feed is None:
+        FEED_REQUESTS.inc(status="404")
         raise MyHTTPException(status_code=404, detail="Something went wrong (aka. no calendar for you) :I")
 
-    new_cal_stream = StringIO(cal)
-    return StreamingResponse(iter([new_cal_stream.getvalue()]), media_type="text/calendar")
+    # Server-Timing shows where the time went (mongo, redis, upstream, parse, copy, prettify, serialize)
+    headers = {**feed.headers, "Server-Timing": server_timing.header()}
+    if feed.is_not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+        FEED_REQUESTS.inc(status="304")
+        return Response(status_code=304, headers=headers)
+
+    FEED_REQUESTS.inc(status="200")
+    return StreamingResponse(feed.iter_bytes(), media_type="text/calendar", headers=headers)
 
 
 @app.get("/api/cal/{token}/string", status_code=200)
 async def get_calender_by_token_string(token: str, response: Response):
-    cal = tiss_cal_handler.prettify_calendar(token)
+    cal = await tiss_cal_handler.prettify_calendar(token)
     if cal is None:
         raise MyHTTPException(status_code=404, detail="Something went wrong (aka. no calendar for you) :I")
     
@@ -242,10 +404,15 @@ async def get_calender_by_token_string(token: str, response: Response):
 @app.get("/api/cal/update/{token}", response_model=TissCalUpdateResponse, status_code=200)
 async def update_calender_by_token(token: str, response: Response, current_user: UserDB = Depends(verify_token)):
     # TODO Check if user is owner
-    cal = tiss_cal_handler.update_calendar_from_source(token)
+    cal = await tiss_cal_handler.update_calendar_from_source(token)
     if cal is None:
         raise MyHTTPException(status_code=404, detail="Something went wrong (aka. no calendar for you) :I")
-    return TissCalUpdateResponse(**cal.dict())
+    return cal
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 if not DEVELOPMENT_MODE:
@@ -27,6 +27,12 @@ Tiss Description:
 {{TissCalDesc}}"""
 
 
+class _TissCalSummaryModel(BaseModel):
+    url: str
+    name: str
+    token: str
+
+
 class _TissCalBase(BaseModel):
     url: str
     name: str
@@ -48,6 +54,68 @@ class TissCalDB(_TissCalBase):
         allow_population_by_field_name = True
         arbitrary_types_allowed = True
 
+    @property
+    def events_by_name(self) -> dict[str, _TissCalEventModel]:
+        """The event configurations keyed by event name (a new dict, changes are not written back to all_events)"""
+        return {event.name: event for event in self.all_events}
+
+    @classmethod
+    def from_document(cls, document: dict, validate: bool = False) -> "TissCalDB":
+        """Creates the calendar from its MongoDB document (see calendar_to_document).
+
+        Documents are only written from validated models (by TissCalHandler and the migrations), so by
+        default they are loaded with construct, without validating every event configuration again.
+
+        Arguments:
+            document {dict} -- the document as returned by pymongo
+
+        Keyword Arguments:
+            validate {bool} -- validate the document like TissCalDB(**data) (default: {False})
+
+        Returns:
+            TissCalDB -- the calendar
+        """
+        data = calendar_from_document(document)
+        if validate:
+            return cls(**data)
+
+        # construct neither converts nested dicts nor removes the alias _id, both is done here
+        data["id"] = data.pop("_id")
+        data["all_events"] = [_TissCalEventModel.construct(**event) for event in data["all_events"]]
+        if "default_template" in data:
+            data["default_template"] = _TissCalDefaultTemplateModel.construct(**data["default_template"])
+        return cls.construct(**data)
+
+
+def event_config_key(name: str) -> str:
+    """Key of the configuration of an event in the events field of a calendar document. MongoDB field
+    names must not contain "." (every LVA name does) or start with "$", "%" is escaped to keep keys unique.
+
+    Arguments:
+        name {str} -- name of the event
+
+    Returns:
+        str -- the key, e.g. "104%2E265 VO Algebra" for "104.265 VO Algebra"
+    """
+    return name.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def calendar_to_document(data: dict) -> dict:
+    """Converts the dict of a TissCalDB(Create) to the document stored in MongoDB, where the list
+    all_events is replaced by the mapping events (event_config_key(name) -> configuration), so single
+    events can be addressed by name (e.g. {"$set": {"events.<key>.will_remove": True}})
+    """
+    document = {key: value for key, value in data.items() if key != "all_events"}
+    document["events"] = {event_config_key(event["name"]): event for event in data["all_events"]}
+    return document
+
+
+def calendar_from_document(document: dict) -> dict:
+    """Inverse of calendar_to_document, the events are returned as the list all_events of the API models"""
+    data = {key: value for key, value in document.items() if key != "events"}
+    data["all_events"] = list(document.get("events", {}).values())
+    return data
+
 
 class TissCalResponse(_TissCalBase, ResponseBase):
     pass
@@ -79,7 +147,8 @@ class TissCalUpdateResponse(TissCalResponse):
 
 
 class TissCalListResponse(ResponseBase):
-    calendars: list[_TissCalBase] = []
+    calendars: list[_TissCalSummaryModel] = []
+    next_cursor: str | None = None
 
 
 class TissCalSuccessDeleteResponse(ResponseBase):
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import sys
+from contextlib import ExitStack
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.Fakes import FakeCollection, FakeRedis, UpstreamStandIn  # noqa: E402
+from benchmarks.SyntheticFeed import generate_calendar_document, generate_feed  # noqa: E402
+from FeedCache import PrerenderedFeedStore  # noqa: E402
+from models.TissCalModels import TissCalDB  # noqa: E402
+from MyCalendar import MyCalendar  # noqa: E402
+from MyMongoClient import AsyncCollection  # noqa: E402
+from TissCalHandler import TissCalHandler  # noqa: E402
+from UpstreamCache import UpstreamCache  # noqa: E402
+
+FEED = generate_feed(events=100, courses=5)
+
+
+@pytest.fixture(autouse=True)
+def backend_cwd(monkeypatch):
+    # resources (rooms, templates) are loaded relative to the backend directory, like in main.py
+    monkeypatch.chdir(BACKEND_DIR)
+
+
+@pytest.fixture
+def feed() -> bytes:
+    return FEED
+
+
+@pytest.fixture
+def upstream_stand_in():
+    """Starts local stand-ins for TISS: upstream_stand_in(content) -> UpstreamStandIn serving content"""
+    with ExitStack() as stack:
+        yield lambda content=FEED: stack.enter_context(UpstreamStandIn(content))
+
+
+@pytest.fixture
+def upstream(upstream_stand_in) -> UpstreamStandIn:
+    return upstream_stand_in()
+
+
+@pytest.fixture
+def collection() -> FakeCollection:
+    return FakeCollection()
+
+
+@pytest.fixture
+def create_calendar(collection):
+    """Stores a calendar for the feed at url: create_calendar(url, content) -> TissCalDB"""
+
+    def create_calendar(url: str, content: bytes = FEED, remove_ratio: float = 0.1) -> TissCalDB:
+        document = generate_calendar_document(url, MyCalendar.from_ical(url, content).get_distinct_events(), remove_ratio)
+        collection.insert_one(document)
+        return TissCalDB.from_document(document)
+
+    return create_calendar
+
+
+@pytest.fixture
+def feed_store() -> PrerenderedFeedStore:
+    return PrerenderedFeedStore(redis_pool=None, redis_client=FakeRedis())
+
+
+@pytest.fixture
+def upstream_caches() -> list[UpstreamCache]:
+    return []
+
+
+@pytest.fixture
+def make_handler(collection, upstream_caches):
+    """Creates TissCalHandlers on the fake collection: make_handler(max_age=0, **kwargs) -> TissCalHandler"""
+
+    def make_handler(max_age: int = 0, **kwargs) -> TissCalHandler:
+        upstream_cache = UpstreamCache(max_age=max_age)
+        upstream_caches.append(upstream_cache)
+        return TissCalHandler(collection=AsyncCollection(collection), upstream_cache=upstream_cache, **kwargs)
+
+    return make_handler
+
+
+@pytest.fixture
+def run(upstream_caches):
+    """Runs a coroutine like asyncio.run, the upstream caches of make_handler are closed in the same event loop"""
+
+    def run(coroutine):
+        async def main():
+            try:
+                return await coroutine
+            finally:
+                for upstream_cache in upstream_caches:
+                    await upstream_cache.close()
+
+        return asyncio.run(main())
+
+    return run
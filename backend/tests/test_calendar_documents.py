@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from Migrations import _key_events_by_name
+from models.TissCalModels import TissCalDB, calendar_from_document, calendar_to_document, event_config_key
+from MyCalendar import MyCalendar
+
+# MongoDB field names must not contain "." or start with "$", "%" is the escape character
+NEW_NAMES = ["104.265 VO Neue LVA", "$Sondertermin", "Anwesenheit 100%", "A.B", "A%2EB"]
+
+
+def test_event_config_key_escapes_mongodb_field_names():
+    assert event_config_key("104.265 VO Algebra") == "104%2E265 VO Algebra"
+    assert event_config_key("$Sondertermin") == "%24Sondertermin"
+    assert event_config_key("100%") == "100%25"
+    # an escaped name does not collide with the name it looks like
+    assert event_config_key("A.B") != event_config_key("A%2EB")
+
+    for key in map(event_config_key, NEW_NAMES):
+        assert "." not in key and not key.startswith("$")
+    assert len(set(map(event_config_key, NEW_NAMES))) == len(NEW_NAMES)
+
+
+def test_document_round_trip(create_calendar, upstream):
+    cal_data = create_calendar(upstream.url)
+    data = cal_data.dict(by_alias=True)
+
+    document = calendar_to_document(data)
+    assert "all_events" not in document
+    assert document["events"] == {event_config_key(event["name"]): event for event in data["all_events"]}
+
+    assert calendar_from_document(document) == data
+    assert TissCalDB.from_document(document) == cal_data
+    assert TissCalDB.from_document(document, validate=True) == cal_data
+
+
+def test_merge_adds_events_with_new_names(create_calendar, upstream, make_handler, collection, run):
+    cal_data = create_calendar(upstream.url)
+    handler = make_handler()
+
+    new_cal = MyCalendar.from_ical(upstream.url, upstream.content)
+    for event, name in zip(new_cal.get_all_events(), NEW_NAMES):
+        event["summary"] = name
+
+    run(handler.merge_calendar_events(cal_data, new_cal))
+
+    stored = run(handler.get_calendar_by_token(cal_data.token))
+    assert set(NEW_NAMES) <= stored.events_by_name.keys()
+    assert stored.events_by_name.keys() == cal_data.events_by_name.keys()
+    assert stored.events_by_name["104.265 VO Neue LVA"].is_lva
+
+    # the new configurations are nested under events, not stored as dotted top level fields
+    document = collection.find_one({"token": cal_data.token})
+    assert all(not key.startswith("events.") for key in document)
+
+
+def test_migration_keys_events_by_name(collection):
+    all_events = [{"name": name, "will_prettify": False, "will_remove": True} for name in NEW_NAMES]
+    collection.insert_one({"token": "old", "all_events": all_events})
+    collection.insert_one({"token": "migrated", "events": {}})
+    db = SimpleNamespace(get_collection=lambda name: collection)
+
+    _key_events_by_name(db, batch_size=1)
+
+    document = collection.find_one({"token": "old"})
+    assert "all_events" not in document
+    assert document["events"] == {event_config_key(event["name"]): event for event in all_events}
+    assert calendar_from_document(document)["all_events"] == all_events
+    assert collection.find_one({"token": "migrated"})["events"] == {}
+
+    # a second run finds nothing to do
+    _key_events_by_name(db)
+    assert collection.find_one({"token": "old"}) == document
@@ -0,0 +1,21 @@
+from benchmarks.SyntheticFeed import generate_feed
+
+
+def test_url_change_invalidates_prerendered_feed(upstream_stand_in, create_calendar, make_handler, feed_store, run):
+    old_upstream = upstream_stand_in(generate_feed(events=50, courses=5, seed=1))
+    new_upstream = upstream_stand_in(generate_feed(events=50, courses=5, seed=2))
+    cal_data = create_calendar(old_upstream.url, old_upstream.content, remove_ratio=0)
+    handler = make_handler(max_age=60, feed_store=feed_store)
+
+    async def change_url():
+        old = await handler.get_feed(cal_data.token)
+        assert (await handler.get_feed(cal_data.token)).etag == old.etag
+        assert old_upstream.requests == 1
+
+        cal_data.url = new_upstream.url
+        await handler.update_calendar(cal_data)
+        new = await handler.get_feed(cal_data.token)
+        assert new_upstream.requests == 1
+        assert new.etag != old.etag
+
+    run(change_url())
@@ -0,0 +1,22 @@
+from RefreshScheduler import RefreshScheduler
+
+
+def test_broken_feed_does_not_end_the_run(upstream_stand_in, create_calendar, make_handler, feed_store, run):
+    working, broken = upstream_stand_in(), upstream_stand_in()
+    create_calendar(working.url)
+    create_calendar(broken.url)
+    handler = make_handler(feed_store=feed_store)
+
+    get_calendar = handler.upstream_cache.get_calendar
+
+    async def get_calendar_or_fail(url: str, max_age: int | None = None):
+        if url == broken.url:
+            raise TypeError("broken feed")
+        return await get_calendar(url, max_age=max_age)
+
+    handler.upstream_cache.get_calendar = get_calendar_or_fail
+    scheduler = RefreshScheduler(tiss_cal_handler=handler)
+
+    stats = run(scheduler.run_once())
+    assert scheduler.last_stats is stats
+    assert (stats.urls_refreshed, stats.calendars_refreshed, stats.failures) == (1, 1, 1)
@@ -0,0 +1,28 @@
+import pstats
+
+from RequestProfiler import RequestProfiler
+
+
+def test_profile_covers_work_in_threads(tmp_path, upstream, create_calendar, make_handler, run):
+    profiler = RequestProfiler(secret="secret", output_dir=str(tmp_path), min_interval=0)
+    token = create_calendar(upstream.url).token
+    handler = make_handler(max_age=0)
+
+    async def get_feed_profiled():
+        with profiler.profile(token) as path:
+            assert await handler.get_feed(token) is not None
+        return path
+
+    functions = {function for _, _, function in pstats.Stats(run(get_feed_profiled())).stats}
+    # mongo (thread pool), parsing and rendering (asyncio.to_thread) run outside of the event loop
+    for function in ("find_one", "from_ical", "render_feed", "prettify", "_prettify_event", "iter_ical"):
+        assert function in functions
+
+
+def test_secret_only_accepted_in_header():
+    profiler = RequestProfiler(secret="secret")
+    assert profiler.is_requested({"X-Profile": "secret"})
+    assert not profiler.is_requested({"X-Profile": "wrong"})
+    # a query parameter would end up in the access log
+    assert not profiler.is_requested({})
+    assert not RequestProfiler().is_requested({"X-Profile": "secret"})
@@ -0,0 +1,35 @@
+import csv
+import os
+import shutil
+
+from FeedCache import EventRenderCache, FeedCache
+from Lva import ROOMS_FILE
+from MyCalendar import MyCalendar
+
+
+def change_building_addresses(file: str, prefix: str):
+    with open(file, "r", encoding="utf-8-sig") as csvfile:
+        rows = list(csv.reader(csvfile, delimiter=";"))
+    with open(file, "w", encoding="utf-8-sig", newline="") as csvfile:
+        csv.writer(csvfile, delimiter=";").writerows(row[:6] + [prefix + row[6]] + row[7:] if len(row) >= 9 else row for row in rows)
+    # a new mtime even on file systems with a coarse timestamp resolution
+    stat = os.stat(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_changed_rooms_file_is_not_served_from_the_caches(tmp_path, monkeypatch, feed, create_calendar, make_handler):
+    # the rooms are read relative to the working directory, the test works on a copy
+    shutil.copytree("resources", tmp_path / "resources")
+    monkeypatch.chdir(tmp_path)
+
+    cal_data = create_calendar("benchmark", feed, remove_ratio=0)
+    handler = make_handler(feed_cache=FeedCache(), event_cache=EventRenderCache())
+    cal = MyCalendar.from_ical("benchmark", feed)
+
+    before = handler.render_feed(cal_data, cal).body
+    assert handler.render_feed(cal_data, cal).body == before
+
+    change_building_addresses(ROOMS_FILE, "Neu ")
+    after = handler.render_feed(cal_data, cal).body
+    assert after != before
+    assert "LOCATION:Neu " in after
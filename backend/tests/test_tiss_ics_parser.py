@@ -0,0 +1,90 @@
+"""Conformance of the TissIcsParser fast path with icalendar on the calendars in tests/corpus.
+Calendars named fallback_*.ics are not handled by the fast path and have to be parsed by icalendar,
+fallback_broken_*.ics can't be parsed by icalendar either.
+"""
+import os
+
+import pytest
+from icalendar.cal import Calendar
+
+from MyCalendar import MyCalendar
+from TissIcsParser import TissCalendar
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+CORPUS = sorted(file for file in os.listdir(CORPUS_DIR) if file.endswith(".ics"))
+FAST_PATH = [file for file in CORPUS if not file.startswith("fallback_")]
+FALLBACK = [file for file in CORPUS if file.startswith("fallback_") and not file.startswith("fallback_broken_")]
+BROKEN = [file for file in CORPUS if file.startswith("fallback_broken_")]
+PARSEABLE = FAST_PATH + FALLBACK
+
+PROPERTIES = ("SUMMARY", "DESCRIPTION", "LOCATION", "DTSTART", "DTEND", "CATEGORIES", "UID")
+
+
+def read_corpus(file: str) -> bytes:
+    with open(os.path.join(CORPUS_DIR, file), "rb") as f:
+        return f.read()
+
+
+def decoded(value):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        # repeated property
+        return [decoded(item) for item in value]
+    if hasattr(value, "dt"):
+        # aware datetimes compare equal across timezones, the offset has to match as well
+        decoded_value = (value.dt, value.dt.utcoffset() if hasattr(value.dt, "utcoffset") else None)
+    elif hasattr(value, "cats"):
+        decoded_value = list(value.cats)
+    else:
+        decoded_value = str(value)
+    return decoded_value, dict(value.params)
+
+
+def decoded_events(cal) -> list[dict]:
+    events = [component for component in cal.subcomponents if component.name == "VEVENT"]
+    return [{name: decoded(event.get(name)) for name in PROPERTIES} for event in events]
+
+
+def test_corpus_has_both_paths():
+    assert FAST_PATH and FALLBACK and BROKEN
+
+
+@pytest.mark.parametrize("file", FAST_PATH)
+def test_fast_path_is_used(file):
+    assert type(MyCalendar.from_ical(file, read_corpus(file)).cal) is TissCalendar
+
+
+@pytest.mark.parametrize("file", FALLBACK)
+def test_fallback_to_icalendar(file):
+    with pytest.raises(ValueError):
+        TissCalendar.from_ical(read_corpus(file))
+    assert type(MyCalendar.from_ical(file, read_corpus(file)).cal) is Calendar
+
+
+@pytest.mark.parametrize("file", BROKEN)
+def test_broken_calendar_is_none(file):
+    # whatever the parsers raise (not only ValueError), the feed is treated as not available
+    assert MyCalendar.from_ical(file, read_corpus(file)) is None
+
+
+def test_any_fast_path_error_falls_back(monkeypatch):
+    def broken_from_ical(content: bytes):
+        raise TypeError("unexpected")
+
+    monkeypatch.setattr(TissCalendar, "from_ical", broken_from_ical)
+    assert type(MyCalendar.from_ical("basic.ics", read_corpus("basic.ics")).cal) is Calendar
+
+
+@pytest.mark.parametrize("file", PARSEABLE)
+def test_decoded_properties_match_icalendar(file):
+    content = read_corpus(file)
+    expected = decoded_events(Calendar.from_ical(content))
+    assert expected
+    assert decoded_events(MyCalendar.from_ical(file, content).cal) == expected
+
+
+@pytest.mark.parametrize("file", FAST_PATH)
+def test_unchanged_calendar_is_written_back_as_parsed(file):
+    content = read_corpus(file)
+    assert TissCalendar.from_ical(content).to_ical() == content
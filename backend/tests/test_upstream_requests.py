@@ -0,0 +1,39 @@
+import asyncio
+
+
+def test_get_feed_requests_upstream_once_per_hit(upstream, create_calendar, make_handler, run):
+    token = create_calendar(upstream.url).token
+    # max_age=0: every feed hit has to ask TISS
+    handler = make_handler(max_age=0)
+
+    async def get_feeds():
+        assert await handler.get_feed(token) is not None
+        assert upstream.requests == 1
+
+        # the second hit is a conditional request (304), but still only one
+        assert await handler.get_feed(token) is not None
+        assert upstream.requests == 2
+
+    run(get_feeds())
+    # the per URL lock is gone once nobody waits for the feed
+    assert handler.upstream_cache._url_locks == {}
+
+
+def test_update_calendar_from_source_requests_upstream_once(upstream, create_calendar, make_handler, run):
+    token = create_calendar(upstream.url).token
+    handler = make_handler(max_age=0)
+
+    assert run(handler.update_calendar_from_source(token)) is not None
+    assert upstream.requests == 1
+
+
+def test_concurrent_get_calendar_downloads_once(upstream, make_handler, run):
+    upstream_cache = make_handler(max_age=60).upstream_cache
+
+    async def get_calendars():
+        return await asyncio.gather(*(upstream_cache.get_calendar(upstream.url) for _ in range(5)))
+
+    calendars = run(get_calendars())
+    assert all(calendar is calendars[0] for calendar in calendars)
+    assert upstream.requests == 1
+    assert upstream_cache._url_locks == {} and upstream_cache._url_lock_users == {}
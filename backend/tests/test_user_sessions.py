@@ -0,0 +1,15 @@
+import pytest
+
+from UserHandler import UserHandler
+
+
+def test_session_token_format():
+    assert UserHandler.is_valid_session_token("aB3" * 10)
+
+
+@pytest.mark.parametrize(
+    "token", [None, "", "abc", "a" * 31, "tisscal:refresh-scheduler", "tisscal:feed:" + "a" * 30, "a" * 29 + "*"]
+)
+def test_other_redis_keys_are_no_session_tokens(token):
+    # a cookie must not make validate_session touch the feed store, the locks or any other key
+    assert not UserHandler.is_valid_session_token(token)